@@ -0,0 +1,113 @@
+import os
+import tempfile
+
+from git import Repo
+from git.exc import GitCommandError
+
+ORIGINAL_COMMIT_MARKER = "Original commit: "
+SCAN_CHUNK_SIZE = 64 * 1024
+
+
+class AppliedCommitIndex:
+    """
+    Source commits already applied to a target repository, persisted in a file under its git directory
+
+    The file maps every source SHA to the target commit which applied it, along with the target commit the
+    index was built up to and the commit it was bounded by. While that tip is an ancestor of the requested
+    commit only newer commits are read, otherwise the index is rebuilt from the history of the requested
+    commit down to the bound.
+    """
+
+    def __init__(self, repo: Repo, path=None):
+        self.repo = repo
+        self.path = path or os.path.join(repo.git_dir, "pipe-syncer", "applied-commits")
+        self.tip = None
+        # commits reachable from this one are left out of the index, None when the whole history is indexed
+        self.since = None
+        # source SHA -> target SHA
+        self.commits = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                header, *lines = f.read().splitlines()
+        except (FileNotFoundError, ValueError):
+            return
+        self.tip, _, since = header.partition(" ")
+        self.since = since or None
+        self.commits = dict(line.split(" ", 1) for line in lines)
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"{self.tip} {self.since or ''}\n")
+            f.writelines(f"{source} {target}\n" for source, target in self.commits.items())
+        os.replace(temp_path, self.path)
+
+    def _is_ancestor(self, ancestor, commit):
+        try:
+            self.repo.git.merge_base("--is-ancestor", ancestor, commit)
+            return True
+        except GitCommandError:
+            # exits with 1 for a commit which is not an ancestor, 128 when one of them is gone
+            return False
+
+    def _covers(self, tip, since):
+        if self.tip is None or (self.tip != tip and not self._is_ancestor(self.tip, tip)):
+            return False
+        # the indexed range has to start no later than the requested one
+        if self.since is None or self.since == since:
+            return True
+        return since is not None and self._is_ancestor(self.since, since)
+
+    def _scan(self, revisions):
+        """
+        Stream the commits mentioning an original commit, without loading commit objects
+
+        :return: mapping of source SHA -> target SHA, the newest target commit wins
+        """
+        # git only greps, "Original commit" isn't a valid trailer key so messages are parsed here
+        process = self.repo.git.log(*revisions, "-z", "--format=%H%n%B", "--fixed-strings",
+                                    f"--grep={ORIGINAL_COMMIT_MARKER}", as_process=True)
+        found = {}
+        tail = b""
+        for chunk in iter(lambda: process.stdout.read(SCAN_CHUNK_SIZE), b""):
+            *records, tail = (tail + chunk).split(b"\0")
+            for record in records:
+                self._parse_record(record, found)
+        self._parse_record(tail, found)
+        process.wait()
+        return found
+
+    @staticmethod
+    def _parse_record(record, found):
+        target, _, message = record.partition(b"\n")
+        marker = ORIGINAL_COMMIT_MARKER.encode()
+        if marker in message:
+            found.setdefault(message.split(marker)[-1].strip().decode(), target.decode())
+
+    def update(self, tip, since=None):
+        """
+        Bring the index up to the target commit
+
+        :param tip: SHA of the target commit, usually the sync branch
+        :param since: SHA of a target commit whose history can't contain commits of interest, like the
+            commit of the latest common tag
+        :return: mapping of source SHA -> target SHA for the commits applied in the history of the tip
+        """
+        if self._covers(tip, since):
+            if tip == self.tip:
+                return self.commits
+            found = self._scan([f"{self.tip}..{tip}"])
+        else:
+            self.commits = {}
+            self.since = since
+            found = self._scan([tip] + ([f"^{since}"] if since else []))
+
+        self.commits.update(found)
+        self.tip = tip
+        self._save()
+        return self.commits
@@ -1,200 +1,610 @@
-import os
+import hashlib
+import io
+import itertools
+import logging
+import multiprocessing
 import re
-import textwrap
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import FrozenSet, Iterator, NamedTuple, Optional, Tuple
 
 import pyperclip
 from git import DiffIndex, Repo, Diff
 
+from cache import placement_key
+from fuzzy import FuzzyMatcher
+from hunk_events import (ALREADY_APPLIED, APPLIED, FUZZY_MATCH, MATCH, NEAR_MISS, UNPLACED, HunkEvent,
+                         RecordingEventSink, logging_event_sink)
+from line_index import FileContent, LineIndex
+from target_store import WorktreeStore
+from utils import PrefixTrie
+
+logger = logging.getLogger(__name__)
+
+# git treats a blob as binary when a NUL byte shows up in its first 8000 bytes
+BINARY_PROBE_SIZE = 8000
+
+
+class DiffHunk(NamedTuple):
+    """
+    Single block of changes of a file diff with its surrounding context
+
+    Hunks are immutable and hashable: lines are kept as tuples of bytes without their line terminator, a
+    trailing CR included. They are never decoded.
+    """
+    a_start: int
+    a_lines: int
+    b_start: int
+    b_lines: int
+    before_context: Tuple[bytes, ...] = ()
+    after_context: Tuple[bytes, ...] = ()
+    removed_lines: Tuple[bytes, ...] = ()
+    added_lines: Tuple[bytes, ...] = ()
+
+
+class ApplyResult(NamedTuple):
+    """
+    Outcome of applying a diff index
+
+    Truthy when the last file diff was applied, like the boolean `CustomApply.apply` used to return.
+    `touched_paths` holds the target paths written, created, removed or renamed, relative to the repository.
+    """
+    applied: bool
+    touched_paths: FrozenSet[str] = frozenset()
+
+    def __bool__(self):
+        return self.applied
+
+
+HUNK_HEADER_RE = re.compile(rb'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+PLUS, MINUS, SPACE, BACKSLASH = b'+- \\'
+
+
+def iter_diff_hunks(patch: bytes) -> Iterator[DiffHunk]:
+    """
+    Parse a unified diff in a single pass and yield its hunks lazily
+
+    Lines are read straight from the patch bytes, and a hunk ends once the line counts from its header are
+    consumed. A count missing from the header means a single line. A hunk is split into several ones
+    wherever a context line is followed by another change, so every yielded hunk has at most one block of
+    removed and added lines.
+
+    :param patch: body of a single file diff, starting with its first hunk header
+    """
+    a_remaining = b_remaining = 0
+    for raw_line in io.BytesIO(patch):
+        if not (a_remaining or b_remaining):
+            header = HUNK_HEADER_RE.match(raw_line)
+            if header is None:
+                continue
+
+            a_start, a_lines, b_start, b_lines = (int(value) if value is not None else 1
+                                                  for value in header.groups())
+            a_remaining, b_remaining = a_lines, b_lines
+            # line numbers of the next line on both sides, split hunks start where their before context does
+            a_line, b_line = a_start, b_start
+            hunk_a_start, hunk_b_start = a_start, b_start
+            before_context = []
+            after_context = []
+            removed_lines = []
+            added_lines = []
+            after_modifications = False
+            last_line_was_context = False
+            continue
+
+        tag = raw_line[0] if raw_line else SPACE
+        if tag == BACKSLASH:  # Ignore lines starting with '\'
+            continue
+
+        line = raw_line[1:].rstrip(b'\r\n')
+
+        if tag == PLUS or tag == MINUS:
+            if last_line_was_context and (removed_lines or added_lines):
+                # If the last line was a context line and we already have removed or added lines,
+                # we should start a new hunk for the broken context
+                yield DiffHunk(hunk_a_start, a_lines, hunk_b_start, b_lines, tuple(before_context),
+                               tuple(after_context), tuple(removed_lines), tuple(added_lines))
+
+                hunk_a_start, hunk_b_start = a_line - len(after_context), b_line - len(after_context)
+                before_context = after_context
+                after_context = []
+                removed_lines = []
+                added_lines = []
+
+            if tag == PLUS:
+                added_lines.append(line)
+                b_line += 1
+                b_remaining -= 1
+            else:
+                removed_lines.append(line)
+                a_line += 1
+                a_remaining -= 1
+            after_modifications = True
+            last_line_was_context = False
+        else:
+            if after_modifications:
+                after_context.append(line)
+            else:
+                before_context.append(line)
+            a_line += 1
+            b_line += 1
+            a_remaining -= 1
+            b_remaining -= 1
+            last_line_was_context = True
+
+        if a_remaining <= 0 and b_remaining <= 0:
+            a_remaining = b_remaining = 0
+            yield DiffHunk(hunk_a_start, a_lines, hunk_b_start, b_lines, tuple(before_context),
+                           tuple(after_context), tuple(removed_lines), tuple(added_lines))
+
+    if a_remaining or b_remaining:
+        # truncated patch, keep what we have read of the last hunk
+        yield DiffHunk(hunk_a_start, a_lines, hunk_b_start, b_lines, tuple(before_context),
+                       tuple(after_context), tuple(removed_lines), tuple(added_lines))
+
 
-class DiffHunk:
-    def __init__(self, a_start, a_lines, b_start, b_lines):
-        self.a_start = a_start
-        self.a_lines = a_lines
-        self.b_start = b_start
-        self.b_lines = b_lines
-        self.before_context = ""
-        self.after_context = ""
-        self.removed_lines = ""
-        self.added_lines = ""
+def _patch_in_worker(dry_run, search_window, fuzz, event_kinds, path, patch, lines, hunks):
+    """
+    Search and splice the hunks of a modified file in a worker process
 
-    def set_content(self, before_context, after_context, removed_lines, added_lines):
-        self.before_context = before_context
-        self.after_context = after_context
-        self.removed_lines = removed_lines
-        self.added_lines = added_lines
+    :return: whether every hunk was placed, placements of the hunks and the events of the given kinds, the
+        caller splices the placements into its own copy of the file
+    """
+    events = RecordingEventSink(event_kinds)
+    custom_apply = CustomApply(None, dry_run=dry_run, search_window=search_window, fuzz=fuzz, events=events)
+    placements = []
+    file_index = custom_apply._patch_lines(path, patch, lines, hunks, placements)
+    return file_index is not None, placements, events.events
+
+
+class _PendingPatch(NamedTuple):
+    """Modified file whose hunks are searched in a worker process"""
+    key: Optional[str]
+    hunks: Tuple[DiffHunk, ...]
+    future: Future
 
 
 class CustomApply:
-    def __init__(self, target_repo: Repo, dry_run=False, interactive=False, replacement_fn=None):
+    def __init__(self, target_repo: Repo, dry_run=False, interactive=False, replacement_fn=None, search_window=100,
+                 chunk_size=64 * 1024, store=None, ignore_prefixes=(), workers=0, placements=None, events=None,
+                 fuzz=0):
         self.dry_run = dry_run
         self.interactive = interactive
         self.target_repo = target_repo
+        # where target files are read and written, the working tree unless syncing headless
+        self.store = store if store is not None else WorktreeStore(target_repo)
+        # target paths starting with one of these are never touched
+        self.ignored = PrefixTrie(ignore_prefixes)
         self.replacement_fn = replacement_fn
+        # number of lines around the position from the hunk header checked before the whole file
+        self.search_window = search_window
+        # size of the blocks created files are copied in
+        self.chunk_size = chunk_size
+        # processes hunks of modified files are searched in, 0 or 1 to do it in this process
+        self.workers = workers
+        self._executor = None
+        # `PlacementCache` remembering where hunks landed in a file, files met again skip the search
+        self.placements = placements
+        # sink of the `HunkEvent`s of the search, logged by default
+        self.events = events if events is not None else logging_event_sink(logger)
+        # fraction of the original lines of a hunk, context included, that may differ from the target ignoring
+        # whitespace when the hunk isn't found exactly, 0 to only place exact matches
+        self.fuzz = fuzz
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def parse_hunks(self, diff_index: DiffIndex):
+        """
+        Parse the hunks of the modified files ahead of `apply`, it is safe to do in another thread
+
+        :return: list with a tuple of hunks for every modified file of the index and None for other diffs
+        """
+        return [tuple(iter_diff_hunks(diff.diff)) if self._is_modify(diff) and not self._is_ignored(diff) else None
+                for diff in diff_index]
+
+    def apply(self, diff_index: DiffIndex, hunks=None) -> ApplyResult:
+        """
+        Apply every file diff of the index to the target
+
+        With more than one worker, hunks of modified files are searched in worker processes while the rest of
+        the work, output included, still happens in the order of the index. Paths are unique within an index,
+        so a modified file reads the same whether it is patched before or after the other diffs.
+
+        :param diff_index: file diffs to apply
+        :param hunks: hunks of the diffs parsed by `parse_hunks`, parsed on demand when not given
+        """
+        if hunks is None and self.placements is not None:
+            # placements are looked up by the hunks of the whole file
+            hunks = self.parse_hunks(diff_index)
+        diffs = list(zip(diff_index, hunks if hunks is not None else itertools.repeat(None)))
+        targets = {}
+        pending = {}
+        modified = [(diff, diff_hunks) for diff, diff_hunks in diffs
+                    if self._is_modify(diff) and not self._is_ignored(diff)]
+        if self.workers > 1 and len(modified) > 1:
+            for diff, diff_hunks in modified:
+                if not self.store.exists(diff.b_path):
+                    continue
+                targets[id(diff)] = blob_sha, content = self._read_target(diff)
+                if content is None:
+                    continue
+                if diff_hunks is None:
+                    # the placements found by the worker are spliced here
+                    diff_hunks = tuple(iter_diff_hunks(diff.diff))
+                key = self._placement_key(blob_sha, diff_hunks)
+                if key is None or self.placements.get(key) is None:
+                    if self._executor is None:
+                        # workers are spawned rather than forked from a process running git and sync threads, they
+                        # only import the modules they need and can't inherit a lock held by another thread
+                        self._executor = ProcessPoolExecutor(self.workers,
+                                                             mp_context=multiprocessing.get_context("spawn"))
+                    event_kinds = {kind for kind in (MATCH, NEAR_MISS, ALREADY_APPLIED, UNPLACED, FUZZY_MATCH, APPLIED)
+                                   if self.events.wants(kind)}
+                    future = self._executor.submit(_patch_in_worker, self.dry_run, self.search_window, self.fuzz,
+                                                   event_kinds, diff.b_path, diff.diff, content.lines, diff_hunks)
+                    pending[id(diff)] = _PendingPatch(key, diff_hunks, future)
 
-    def apply(self, diff_index: DiffIndex):
         patch_applied = False
-        for diff in diff_index:
+        touched_paths = set()
+        for diff, diff_hunks in diffs:
+            if self._is_ignored(diff):
+                print(f"Skipped ignored file {diff.b_path or diff.a_path}")
+                # nothing has to be changed for an ignored file
+                patch_applied = True
+                continue
+
             if diff.deleted_file:
                 patch_applied = self._handle_delete(diff)
+                paths = (diff.a_path,)
             elif diff.new_file:
                 patch_applied = self._handle_create(diff)
+                paths = (diff.b_path,)
             elif diff.renamed_file:
                 patch_applied = self._handle_rename(diff)
+                paths = (diff.a_path, diff.b_path)
             else:
-                patch_applied = self._handle_modify(diff)
+                patch_applied = self._handle_modify(diff, diff_hunks, targets.get(id(diff)), pending.get(id(diff)))
+                paths = (diff.b_path,)
+
+            if patch_applied and not self.dry_run:
+                touched_paths.update(paths)
 
-        return patch_applied
+        return ApplyResult(patch_applied, frozenset(touched_paths))
+
+    def _is_ignored(self, diff: Diff):
+        return self.ignored and all(self.ignored.match(path) for path in {diff.a_path, diff.b_path} if path)
+
+    @staticmethod
+    def _is_modify(diff: Diff):
+        return not (diff.deleted_file or diff.new_file or diff.renamed_file)
 
     def _handle_delete(self, diff: Diff):
-        file_path = os.path.join(self.target_repo.working_dir, diff.a_path)
-        if os.path.exists(file_path):
+        if self.store.exists(diff.a_path):
             if not self.dry_run:
-                os.remove(file_path)
+                self.store.remove(diff.a_path)
                 print(f"Deleted file {diff.a_path}")
             return True
         return False
 
     def _handle_create(self, diff: Diff):
-        file_path = os.path.join(self.target_repo.working_dir, diff.b_path)
-        dir_path = os.path.dirname(file_path)  # get the directory path
-
-        # make sure all directories exist
-        os.makedirs(dir_path, exist_ok=True)
-        if not os.path.exists(file_path):
+        if not self.store.exists(diff.b_path):
             if not self.dry_run:
-                with open(file_path, 'w') as f:
-                    content = diff.b_blob.data_stream.read()
-                    # Apply the replacement function if it is defined
-                    if self.replacement_fn is not None:
-                        content = self.replacement_fn(content)
-                    f.write(content.decode('utf-8'))
+                with self.store.open(diff.b_path, 'wb') as f:
+                    for chunk in self._blob_chunks(diff.b_blob):
+                        f.write(chunk)
                 print(f"Created file {diff.b_path}")
             return True
         return False
 
-    def _handle_rename(self, diff: Diff):
-        old_file_path = os.path.join(self.target_repo.working_dir, diff.a_path)
-        new_file_path = os.path.join(self.target_repo.working_dir, diff.b_path)
+    def _blob_chunks(self, blob):
+        """
+        Read the blob in chunks passed through the replacement function
+
+        Binary blobs are copied as they are. A replacement function with a `stream` method gets the chunks
+        one by one, any other callable still receives the whole content.
+        """
+        stream = blob.data_stream
+        first_chunk = stream.read(self.chunk_size)
+        chunks = itertools.chain([first_chunk], iter(lambda: stream.read(self.chunk_size), b""))
+        if not self.replacement_fn or b"\0" in first_chunk[:BINARY_PROBE_SIZE]:
+            return chunks
+
+        stream_fn = getattr(self.replacement_fn, 'stream', None)
+        if stream_fn is None:
+            return [self.replacement_fn(b"".join(chunks))]
+        return stream_fn(chunks)
 
-        if os.path.exists(old_file_path):
+    def _handle_rename(self, diff: Diff):
+        if self.store.exists(diff.a_path):
             if not self.dry_run:
-                os.rename(old_file_path, new_file_path)
+                self.store.rename(diff.a_path, diff.b_path)
                 print(f"Renamed file {diff.a_path} to {diff.b_path}")
             return True
         return False
 
-    def _handle_modify(self, diff: Diff):
-        print(f"Working on M path in file {diff.b_path}")
-        file_path = os.path.join(self.target_repo.working_dir, diff.b_path)
-        if not os.path.exists(file_path):
+    def _is_pre_image(self, diff: Diff, blob_sha, data=None):
+        """
+        Whether the target file is the original version of the diff after replacements
+
+        Without replacements the blob SHAs are compared. Otherwise the original version is rewritten chunk by
+        chunk and compared with the target file, up to the first difference.
+
+        :param blob_sha: SHA of the target file as a git blob
+        :param data: content of the target file, needed with replacements only
+        """
+        if diff.a_blob is None or diff.b_blob is None:
+            return False
+        if not self.replacement_fn:
+            return blob_sha == diff.a_blob.hexsha
+        if data is None:
+            return False
+        offset = 0
+        for chunk in self._blob_chunks(diff.a_blob):
+            if data[offset:offset + len(chunk)] != chunk:
+                return False
+            offset += len(chunk)
+        return offset == len(data)
+
+    def _handle_modify(self, diff: Diff, hunks=None, target=None, pending=None):
+        """
+        :param hunks: hunks of the diff, parsed on demand when not given
+        :param target: blob SHA and content of the target file already read by `_read_target`
+        :param pending: hunk search running in a worker process
+        """
+        logger.debug(f"Working on M path in file {diff.b_path}")
+        if not self.store.exists(diff.b_path):
             print(f"Target file path not found, maybe file was already renamed or removed: {diff.b_path}")
             return False
 
-        diff_chunks = self._extract_diff_chunks(diff)
+        blob_sha, content = target if target is not None else self._read_target(diff)
+        if content is None:
+            print(f"Target file matches the original version, taking the new one: {diff.b_path}")
+            if not self.dry_run:
+                with self.store.open(diff.b_path, 'wb') as f:
+                    for chunk in self._blob_chunks(diff.b_blob):
+                        f.write(chunk)
+            return True
+
+        with content:
+            if pending is None:
+                file_index = self._place_lines(diff.b_path, diff.diff, blob_sha, content.lines, hunks)
+            else:
+                placed, placements, events = pending.future.result()
+                for event in events:
+                    self.events.emit(event)
+                file_index = None
+                if placed:
+                    file_index = self._splice_placements(content.lines, pending.hunks, placements)
+                    if pending.key is not None:
+                        self.placements.put(pending.key, placements)
+
+            if file_index is None:
+                patch = f"--- a/{diff.a_path}\n" \
+                        + f"+++ a/{diff.b_path}\n" \
+                        + diff.diff.decode() \
+                        + "\n--\n"
+
+                if self.interactive:
+                    print(f"Unable to apply patch, moved to you clipboard")
+                    pyperclip.copy(patch)
+                    input("To continue press any key...")
+                else:
+                    print(f"Unable to apply patch, you can copy it and use IDE:")
+                    print(f"\n{patch}")
+                return False
+
+            if not self.dry_run:
+                # unchanged byte ranges are copied around the spliced hunks, the file is replaced once written
+                with self.store.open(diff.b_path, 'wb') as f:
+                    f.writelines(content.chunks(file_index))
+        return True
+
+    def _read_target(self, diff: Diff):
+        """
+        Read the target file of a modified file once for the pre-image check, the placement key and the search
+
+        The SHA of a file the store knows without reading it is taken as it is, and a file with the SHA of the
+        original version isn't read at all when there are no replacements.
 
-        with open(file_path, 'r') as f:
-            file_lines = [line.strip('\n') for line in f.readlines()]
+        :return: SHA of the target file as a git blob and its content, which the caller closes, or None instead
+            of the content when the file is the original version of the diff
+        """
+        blob_sha = self.store.known_blob_sha(diff.b_path)
+        if blob_sha is not None and self._is_pre_image(diff, blob_sha):
+            return blob_sha, None
+        data = self.store.read(diff.b_path)
+        if blob_sha is None:
+            digest = hashlib.sha1(b"blob %d\0" % len(data))
+            digest.update(data)
+            blob_sha = digest.hexdigest()
+        if self._is_pre_image(diff, blob_sha, data):
+            if not isinstance(data, bytes):
+                data.close()
+            return blob_sha, None
+        return blob_sha, FileContent(data)
+
+    def _placement_key(self, blob_sha, hunks):
+        if self.placements is None:
+            return None
+        return placement_key(blob_sha, hunks, self.search_window, self.fuzz, self.dry_run)
+
+    def _place_lines(self, path, patch, blob_sha, lines, hunks):
+        """
+        Patch the lines of the target file, reusing the placement of the hunks when the same file was met before
 
+        :return: the patched lines or None when some hunk couldn't be placed
+        """
+        key = self._placement_key(blob_sha, hunks)
+        placements = None if key is None else self.placements.get(key)
+        if placements is not None and len(placements) == len(hunks):
+            logger.debug(f"Reusing the placement of {len(hunks)} hunk(s) in {path}")
+            for hunk_id, (chunk, (position, _)) in enumerate(zip(hunks, placements)):
+                self._emit(APPLIED, path, hunk_id, chunk, position)
+            return self._splice_placements(lines, hunks, placements)
+
+        placements = []
+        file_index = self._patch_lines(path, patch, lines, hunks, placements)
+        if key is not None and file_index is not None:
+            self.placements.put(key, placements)
+        return file_index
+
+    def _splice_placements(self, lines, hunks, placements):
+        """
+        :return: the lines with the added lines of every hunk spliced where it was placed
+        """
+        file_index = LineIndex(lines)
+        if not self.dry_run:
+            for chunk, (position, replace_len) in zip(hunks, placements):
+                file_index.splice(position, replace_len, chunk.added_lines)
+        return file_index
+
+    def _patch_lines(self, path, patch, lines, hunks=None, placements=None):
+        """
+        Place every hunk of the patch in the lines of the target file
+
+        :param path: target path, only passed along in events
+        :param patch: body of the file diff
+        :param lines: lines of the target file without line terminators
+        :param hunks: hunks of the patch when they are already parsed
+        :param placements: list the (position, replace length) of every placed hunk is appended to
+        :return: the patched lines or None when some hunk couldn't be placed
+        """
+        file_index = LineIndex(lines)
+        matcher = FuzzyMatcher(file_index, self.fuzz) if self.fuzz else None
         all_patches_applied = True
-        for chunk in diff_chunks:
-            start_position, replace_len = self._search_context(file_lines, chunk)
+        # like `patch`, track how far hunks landed from their header position and expect the same offset
+        # for the next ones
+        offset = 0
+        for hunk_id, chunk in enumerate(hunks if hunks is not None else iter_diff_hunks(patch)):
+            original_position = self._header_position(chunk)
+            start_position, replace_len = self._search_context(file_index, chunk, original_position + offset,
+                                                               path, hunk_id, matcher)
             if start_position != -1:
+                offset = start_position - original_position
+                if placements is not None:
+                    placements.append((start_position, replace_len))
                 if not self.dry_run:
-                    file_lines[start_position: start_position + replace_len] = chunk.added_lines
-                print(f"Applied change in {diff.b_path} at line {start_position + 1}")
+                    file_index.splice(start_position, replace_len, chunk.added_lines)
+                    if matcher is not None:
+                        matcher.splice(start_position, replace_len, chunk.added_lines)
+                    offset += len(chunk.added_lines) - replace_len
+                self._emit(APPLIED, path, hunk_id, chunk, start_position)
             else:
                 all_patches_applied = False
 
-        if not all_patches_applied:
-            patch = f"--- a/{diff.a_path}\n" \
-                    + f"+++ a/{diff.b_path}\n" \
-                    + diff.diff.decode() \
-                    + "\n--\n"
-
-            if self.interactive:
-                print(f"Unable to apply patch, moved to you clipboard")
-                pyperclip.copy(patch)
-                input("To continue press any key...")
-            else:
-                print(f"Unable to apply patch, you can copy it and use IDE:")
-                print(f"\n{patch}")
-            return False
-
-        if not self.dry_run:
-            with open(file_path, 'w') as f:
-                f.writelines([f"{line}\n" for line in file_lines])
-        return True
-
-    def _extract_diff_chunks(self, diff: Diff) -> list[DiffHunk]:
-        diff_chunks = []
-        diff_string = diff.diff.decode()
+        return file_index if all_patches_applied else None
 
-        hunks = re.findall(r'@@ -(\d+),(\d+) \+(\d+),(\d+) @@', diff_string)
-        hunk_contents = re.split(r'@@ -\d+,\d+ \+\d+,\d+ @@(?:\n)?', diff_string)[1:]
+    @staticmethod
+    def _header_position(hunk: DiffHunk):
+        """
+        0-based position of the first removed line of the hunk in the original file
+        """
+        if hunk.a_lines == 0:
+            # hunks without lines on the original side point to the line after which they are inserted
+            return hunk.a_start
+        return hunk.a_start - 1 + len(hunk.before_context)
 
-        for hunk, content in zip(hunks, hunk_contents):
-            a_start, a_lines, b_start, b_lines = map(int, hunk)
-            diff_hunk = DiffHunk(a_start, a_lines, b_start, b_lines)
+    def _emit(self, kind, path, hunk_id, hunk, position=-1, context=(0, 0), found_lines=(), distance=0):
+        if self.events.wants(kind):
+            self.events.emit(HunkEvent(kind, path, hunk_id, hunk, position, context, tuple(found_lines), distance))
 
-            content_lines = content.splitlines()
+    def _candidate_offsets(self, file_index: LineIndex, hunk: DiffHunk, start_len, end_len):
+        """
+        Offsets where a hunk matched with the given context lengths may start, in ascending order
 
-            before_context = []
-            after_context = []
-            removed_lines = []
-            added_lines = []
+        Instead of sliding over every line of the file, the rarest line of the start context is looked up
+        in the index. Without start context the first line of the end context is used as an anchor, both for
+        the original and for the already applied layout of the hunk.
 
-            after_modifications = False
-            last_line_was_context = False
-            for line in content_lines:
-                if line.startswith('\\'):  # Ignore lines starting with '\'
-                    continue
+        :param file_index: index of the target file lines
+        :param hunk: hunk to locate
+        :param start_len: number of lines taken from the end of the hunk before context
+        :param end_len: number of lines taken from the beginning of the hunk after context
+        :return: iterable of candidate offsets of the start context
+        """
+        last_idx = len(file_index) - start_len - end_len - len(hunk.removed_lines)
+        if last_idx < 0:
+            return ()
+
+        if start_len:
+            context_start = hunk.before_context[len(hunk.before_context) - start_len:]
+            anchor = min(range(start_len), key=lambda k: len(file_index.positions(context_start[k])))
+            return (p - anchor for p in file_index.positions(context_start[anchor])
+                    if anchor <= p <= last_idx + anchor)
+
+        anchor_positions = file_index.positions(hunk.after_context[0])
+        candidates = {p - len(hunk.removed_lines) for p in anchor_positions}
+        candidates.update(p - len(hunk.added_lines) for p in anchor_positions)
+        return sorted(idx for idx in candidates if 0 <= idx <= last_idx)
+
+    def _check_offset(self, file_lines: LineIndex, hunk: DiffHunk, idx, possible_context_start,
+                      possible_context_end, path=None, hunk_id=0):
+        """
+        Compare the hunk with the file assuming that its start context begins at `idx`, emitting an event
+        for a match, a near miss or an already applied hunk
 
-                if line.startswith('+') or line.startswith('-'):
-                    if last_line_was_context and (removed_lines or added_lines):
-                        # If the last line was a context line and we already have removed or added lines,
-                        # we should start a new hunk for the broken context
-                        diff_hunk.set_content(before_context, after_context, removed_lines, added_lines)
-                        diff_chunks.append(diff_hunk)
-                        diff_hunk = DiffHunk(a_start, a_lines, b_start, b_lines)
-
-                        before_context = after_context
-                        after_context = []
-                        removed_lines = []
-                        added_lines = []
-
-                    if line.startswith('+'):
-                        added_lines.append(line[1:])
-                    elif line.startswith('-'):
-                        removed_lines.append(line[1:])
-                    after_modifications = True
-                    last_line_was_context = False
-                else:
-                    line = line[1:]  # Remove the space in front of the context lines
-                    if after_modifications:
-                        after_context.append(line)
-                    else:
-                        before_context.append(line)
-                    last_line_was_context = True
+        :return: (position, replace length) on a match, (-1, -1) on a potential match with different content
+                 and None otherwise
+        """
+        match_start_len = len(possible_context_start)
+        match_end_len = len(possible_context_end)
+        file_context_start = file_lines[idx:idx + match_start_len]
+
+        if file_context_start != possible_context_start:
+            return None
+
+        file_context_end_start_index = idx + match_start_len + len(hunk.removed_lines)
+        file_context_end_end_index = idx + match_start_len + len(hunk.removed_lines) + match_end_len
+        file_context_end = file_lines[file_context_end_start_index:file_context_end_end_index]
+
+        file_context_applied_start_index = idx + match_start_len + len(hunk.added_lines)
+        file_context_applied_end_index = idx + match_start_len + len(hunk.added_lines) + match_end_len
+        file_context_applied = file_lines[file_context_applied_start_index:file_context_applied_end_index]
+
+        if file_context_end == possible_context_end:
+            # Check if the deleted lines match the lines in the original file
+            file_removed_lines_start_idx = idx + match_start_len
+            file_removed_lines_end_idx = file_context_end_start_index
+            file_removed_lines = file_lines[file_removed_lines_start_idx:file_removed_lines_end_idx]
+
+            if file_removed_lines == hunk.removed_lines:
+                self._emit(MATCH, path, hunk_id, hunk, idx + match_start_len, (match_start_len, match_end_len))
+                return idx + match_start_len, len(hunk.removed_lines)
+            else:
+                self._emit(NEAR_MISS, path, hunk_id, hunk, idx + match_start_len, (match_start_len, match_end_len),
+                           file_removed_lines)
+                return -1, -1
 
-            diff_hunk.set_content(before_context, after_context, removed_lines, added_lines)
-            diff_chunks.append(diff_hunk)
+        elif file_context_applied == possible_context_end:
+            file_added_lines_end_idx = idx + match_start_len + len(hunk.added_lines)
+            file_added_lines = file_lines[idx + match_start_len:file_added_lines_end_idx]
 
-        return diff_chunks
+            if file_added_lines == hunk.added_lines:
+                self._emit(ALREADY_APPLIED, path, hunk_id, hunk, idx + match_start_len,
+                           (match_start_len, match_end_len))
+                return idx + match_start_len, len(hunk.added_lines)
 
-    def _format_log_lines(self, lines, prefix="| "):
-        if len(lines):
-            return textwrap.indent("\n".join(lines), prefix) + "\n"
-        return ""
+        return None
 
-    def _search_context(self, file_lines, hunk: DiffHunk):
+    def _search_context(self, file_lines: LineIndex, hunk: DiffHunk, expected_position=None, path=None, hunk_id=0,
+                        matcher: FuzzyMatcher = None):
         """
         Locating line number based on hunk surround context using variable lengths
 
-        :param file_lines:
-        :param context_start:
-        :param context_end:
-        :param removed_lines:
-        :return:
+        Context lengths are tried longest first. With an expected position, taken from the hunk header and
+        corrected by the drift of previous hunks, offsets within `search_window` lines around it are checked
+        nearest first, and only on a miss the rest of `_candidate_offsets` is compared, again nearest first.
+        A hunk found nowhere, or only as a near miss, is left to the fuzzy matcher when there is one.
+
+        :param file_lines: index of the target file lines
+        :param hunk: hunk to locate
+        :param expected_position: expected position of the first replaced line, if known
+        :param path: target path, only passed along in events
+        :param hunk_id: index of the hunk in its file diff, only passed along in events
+        :param matcher: `FuzzyMatcher` over the same lines, if differences are tolerated
+        :return: position of the first replaced line and number of lines to replace, or (-1, -1)
         """
 
         def generate_combinations(start_len, end_len):
@@ -211,11 +621,8 @@ class CustomApply:
         max_start_len = len(hunk.before_context)
         max_end_len = len(hunk.after_context)
 
-        # Remove whitespaces from context lines
-        # context_start = [line.replace(" ", "") for line in context_start]
-        # context_end = [line.replace(" ", "") for line in context_end]
-
-        #
+        # a hunk without any context has no combination to try
+        possible_match_found = False
         for match_start_len, match_end_len in generate_combinations(max_start_len, max_end_len):
             # taking [l-N:l] lines from the context start
             possible_context_start = hunk.before_context[
@@ -225,63 +632,51 @@ class CustomApply:
             possible_context_end = hunk.after_context[0:match_end_len]
             possible_match_found = False
 
-            for idx in range(len(file_lines) - match_start_len - match_end_len - len(hunk.removed_lines) + 1):
-                file_context_start = file_lines[idx:idx + match_start_len]
-
-                # Remove whitespaces from file context lines
-                # file_context_start = [line.replace(" ", "") for line in file_context_start]
-                # file_context_end = [line.replace(" ", "") for line in file_context_end]
-
-                if file_context_start == possible_context_start:
-                    file_context_end_start_index = idx + match_start_len + len(hunk.removed_lines)
-                    file_context_end_end_index = idx + match_start_len + len(hunk.removed_lines) + match_end_len
-                    file_context_end = file_lines[file_context_end_start_index:file_context_end_end_index]
-
-                    file_context_applied_start_index = idx + match_start_len + len(hunk.added_lines)
-                    file_context_applied_end_index = idx + match_start_len + len(hunk.added_lines) + match_end_len
-                    file_context_applied = file_lines[file_context_applied_start_index:file_context_applied_end_index]
-
-                    if file_context_end == possible_context_end:
-                        # Check if the deleted lines match the lines in the original file
-                        file_removed_lines_start_idx = idx + match_start_len
-                        file_removed_lines_end_idx = file_context_end_start_index
-                        file_removed_lines = file_lines[file_removed_lines_start_idx:file_removed_lines_end_idx]
-
-                        if file_removed_lines == hunk.removed_lines:
-                            print(
-                                f"Found match with context at {idx + match_start_len}: {match_start_len}/{match_end_len}")
-                            print(self._format_log_lines(file_context_start)
-                                  + self._format_log_lines(hunk.removed_lines, " -")
-                                  + self._format_log_lines(hunk.added_lines, " +")
-                                  + self._format_log_lines(file_context_end))
-
-                            return idx + match_start_len, len(hunk.removed_lines)
-                        else:
-                            print(f"Fount potential match, "
-                                  f"but content differ, at {idx + match_start_len}: {match_start_len}/{match_end_len}")
-                            print("Expected:")
-                            print(self._format_log_lines(hunk.removed_lines))
-                            print("Found:")
-                            print(self._format_log_lines(file_removed_lines))
+            last_idx = len(file_lines) - match_start_len - match_end_len - len(hunk.removed_lines)
+            window = range(0)
+            if expected_position is not None and self.search_window:
+                center = expected_position - match_start_len
+                window = range(max(center - self.search_window, 0), min(center + self.search_window, last_idx) + 1)
+                for distance in range(self.search_window + 1):
+                    for idx in (center - distance, center + distance) if distance else (center,):
+                        if idx not in window:
+                            continue
+                        result = self._check_offset(file_lines, hunk, idx, possible_context_start,
+                                                    possible_context_end, path, hunk_id)
+                        if result == (-1, -1):
                             possible_match_found = True
+                        elif result is not None:
+                            return result
+                candidates = sorted((idx for idx in self._candidate_offsets(file_lines, hunk, match_start_len,
+                                                                             match_end_len) if idx not in window),
+                                    key=lambda idx: abs(idx - center))
+            else:
+                candidates = self._candidate_offsets(file_lines, hunk, match_start_len, match_end_len)
 
-                    elif file_context_applied == possible_context_end:
-                        file_added_lines_end_idx = idx + match_start_len + len(hunk.added_lines)
-                        file_added_lines = file_lines[idx + match_start_len:file_added_lines_end_idx]
-
-                        if file_added_lines == hunk.added_lines:
-                            print(f"Diff already applied at {idx + match_start_len}: {match_start_len}/{match_end_len}")
-                            print(self._format_log_lines(file_added_lines, " +"))
-                            return idx + match_start_len, len(hunk.added_lines)
+            for idx in candidates:
+                result = self._check_offset(file_lines, hunk, idx, possible_context_start, possible_context_end,
+                                            path, hunk_id)
+                if result == (-1, -1):
+                    possible_match_found = True
+                elif result is not None:
+                    return result
 
             if possible_match_found:
                 # We found potential match in a file, and we do not need to reduce context to locate
                 # the potential match
-                return -1, -1
+                break
+
+        if matcher is not None:
+            match = matcher.find(hunk, expected_position)
+            if match is not None:
+                if match.already_applied:
+                    self._emit(ALREADY_APPLIED, path, hunk_id, hunk, match.position)
+                else:
+                    self._emit(FUZZY_MATCH, path, hunk_id, hunk, match.position,
+                               found_lines=file_lines[match.position:match.position + match.replace_len],
+                               distance=match.distance)
+                return match.position, match.replace_len
 
-        print("Couldn't find context for")
-        print(self._format_log_lines(hunk.before_context)
-              + self._format_log_lines(hunk.removed_lines, " -")
-              + self._format_log_lines(hunk.added_lines, " +")
-              + self._format_log_lines(hunk.after_context))
+        if not possible_match_found:
+            self._emit(UNPLACED, path, hunk_id, hunk)
         return -1, -1
@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of the unified diff parser on multi-megabyte patches
+
+Compares `iter_diff_hunks` with the previous regex `findall`/`split` extraction. Nothing outlives a hunk
+in the parser, so when the hunks are consumed lazily the peak memory is the size of a single hunk, well
+under 0.1 MB, whatever the size of the patch.
+
+Run from the repository root:
+
+    python -m benchmarks.diff_parser_bench [size in MB]
+"""
+import random
+import re
+import sys
+import timeit
+import tracemalloc
+
+from apply import iter_diff_hunks
+
+
+def generate_patch(size):
+    rnd = random.Random(0)
+    chunks = []
+    total = 0
+    line_number = 1
+    while total < size:
+        context = [f" def value{rnd.randrange(10 ** 6)} = config.get('key{line_number}')\n" for _ in range(10)]
+        removed = [f"-    println \"removed line {line_number + idx}\"\n" for idx in range(rnd.randint(0, 4))]
+        added = [f"+    println \"added line {line_number + idx}\"\n" for idx in range(rnd.randint(1, 4))]
+        a_lines = len(context) + len(removed)
+        b_lines = len(context) + len(added)
+        chunk = f"@@ -{line_number},{a_lines} +{line_number},{b_lines} @@ class Generated\n" \
+                + "".join(context[:5] + removed + added + context[5:])
+        chunks.append(chunk)
+        total += len(chunk)
+        line_number += a_lines + 20
+    return "".join(chunks).encode()
+
+
+class LegacyHunk:
+    def __init__(self, a_start, a_lines, b_start, b_lines):
+        self.a_start = a_start
+        self.a_lines = a_lines
+        self.b_start = b_start
+        self.b_lines = b_lines
+        self.before_context = ""
+        self.after_context = ""
+        self.removed_lines = ""
+        self.added_lines = ""
+
+    def set_content(self, before_context, after_context, removed_lines, added_lines):
+        self.before_context = before_context
+        self.after_context = after_context
+        self.removed_lines = removed_lines
+        self.added_lines = added_lines
+
+
+def legacy_extract(patch):
+    diff_chunks = []
+    diff_string = patch.decode()
+
+    hunks = re.findall(r'@@ -(\d+),(\d+) \+(\d+),(\d+) @@', diff_string)
+    hunk_contents = re.split(r'@@ -\d+,\d+ \+\d+,\d+ @@(?:\n)?', diff_string)[1:]
+
+    for hunk, content in zip(hunks, hunk_contents):
+        a_start, a_lines, b_start, b_lines = map(int, hunk)
+        diff_hunk = LegacyHunk(a_start, a_lines, b_start, b_lines)
+        before_context, after_context, removed_lines, added_lines = [], [], [], []
+        after_modifications = False
+        last_line_was_context = False
+        for line in content.splitlines():
+            if line.startswith('\\'):
+                continue
+            if line.startswith('+') or line.startswith('-'):
+                if last_line_was_context and (removed_lines or added_lines):
+                    diff_hunk.set_content(before_context, after_context, removed_lines, added_lines)
+                    diff_chunks.append(diff_hunk)
+                    diff_hunk = LegacyHunk(a_start, a_lines, b_start, b_lines)
+                    before_context, after_context, removed_lines, added_lines = after_context, [], [], []
+                if line.startswith('+'):
+                    added_lines.append(line[1:])
+                elif line.startswith('-'):
+                    removed_lines.append(line[1:])
+                after_modifications = True
+                last_line_was_context = False
+            else:
+                if after_modifications:
+                    after_context.append(line[1:])
+                else:
+                    before_context.append(line[1:])
+                last_line_was_context = True
+        diff_hunk.set_content(before_context, after_context, removed_lines, added_lines)
+        diff_chunks.append(diff_hunk)
+    return diff_chunks
+
+
+def measure(name, fn, patch, repeat=5):
+    seconds = min(timeit.repeat(lambda: fn(patch), number=1, repeat=repeat))
+    tracemalloc.start()
+    fn(patch)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>16}: {seconds * 1000:8.1f} ms {len(patch) / seconds / 2 ** 20:8.1f} MB/s "
+          f"peak {peak / 2 ** 20:8.1f} MB")
+
+
+def main():
+    size = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    patch = generate_patch(int(size * 2 ** 20))
+    print(f"patch: {len(patch) / 2 ** 20:.1f} MB, {patch.count(b'@@ -')} hunks")
+    measure("regex split", legacy_extract, patch)
+    measure("iter_diff_hunks", lambda data: list(iter_diff_hunks(data)), patch)
+    # lazily consumed hunks, like _handle_modify does
+    measure("streamed", lambda data: sum(1 for _ in iter_diff_hunks(data)), patch)
+
+
+if __name__ == '__main__':
+    main()
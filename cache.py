@@ -0,0 +1,236 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+from git import Diff, DiffIndex, Repo
+
+# bumped whenever the layout of an entry or the way patches are prepared changes
+CACHE_FORMAT = 2
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# placements kept when the file of the placement cache is compacted
+DEFAULT_MAX_PLACEMENTS = 100000
+
+_DIFF_FIELDS = ('a_mode', 'b_mode', 'a_rawpath', 'b_rawpath', 'new_file', 'deleted_file', 'copied_file',
+                'raw_rename_from', 'raw_rename_to', 'diff', 'change_type', 'score')
+
+
+def patch_cache_key(commit_sha, rules, *options):
+    """
+    Key of a prepared patch
+
+    :param commit_sha: SHA of the source commit
+    :param rules: (search, replace) pairs the patch was rewritten with, in order
+    :param options: anything else the prepared patch depends on, like the context size or ignored folders
+    :return: hex digest
+    """
+    return hashlib.sha256(repr((CACHE_FORMAT, commit_sha, list(rules), options)).encode()).hexdigest()
+
+
+def placement_key(blob_sha, hunks, *options):
+    """
+    Key of the placement of a file diff
+
+    :param blob_sha: SHA of the target file blob the hunks are placed in
+    :param hunks: every hunk of the file diff, later hunks are placed in the file changed by the earlier ones
+    :param options: anything else the placement depends on, like the search window
+    :return: hex digest
+    """
+    return hashlib.sha256(repr((CACHE_FORMAT, blob_sha, tuple(hunks), options)).encode()).hexdigest()
+
+
+def _dump_blob(blob):
+    return None if blob is None else (type(blob), blob.binsha, blob.mode, blob.path)
+
+
+def _load_blob(repo, fields):
+    if fields is None:
+        return None
+    blob_type, binsha, mode, path = fields
+    return blob_type(repo, binsha, mode=mode, path=path)
+
+
+def _load_diff(repo, fields):
+    # Diff.__init__ looks every path up among the submodules, the stored fields are set as they were
+    diff = Diff.__new__(Diff)
+    a_blob, b_blob, *values = fields
+    for name, value in zip(_DIFF_FIELDS, values):
+        setattr(diff, name, value)
+    diff.a_blob = _load_blob(repo, a_blob)
+    diff.b_blob = _load_blob(repo, b_blob)
+    return diff
+
+
+class PatchCache:
+    """
+    Rewritten and parsed patches of source commits, persisted in files under the git directory of the source
+
+    Entries are addressed by `patch_cache_key`, so a changed replacement rule or option simply misses. Reading
+    an entry bumps its modification time and once the entries outgrow `max_size` the least recently used ones
+    are removed, across runs as well.
+    """
+
+    def __init__(self, repo: Repo, max_size=DEFAULT_MAX_SIZE, path=None):
+        self.path = path or os.path.join(repo.git_dir, "pipe-syncer", "patch-cache")
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # path -> size, least recently used first, scanned on the first write
+        self._entries = None
+        self._size = 0
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    def get(self, key, repo: Repo):
+        """
+        Load a prepared patch
+
+        :param key: key of the entry
+        :param repo: source repository the blobs of the diffs are read from
+        :return: (diff index, hunks) or None when there is no usable entry
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                diffs, hunks = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a truncated entry or one written by a different version is a miss
+            self._remove(path)
+            return None
+
+        with self._lock:
+            if self._entries is not None and path in self._entries:
+                self._entries[path] = self._entries.pop(path)
+        return DiffIndex(_load_diff(repo, fields) for fields in diffs), hunks
+
+    def put(self, key, diff_index, hunks):
+        """
+        Store a prepared patch, evicting the least recently used entries when the cache grows too big
+
+        :param key: key of the entry
+        :param diff_index: rewritten file diffs
+        :param hunks: hunks of the diffs as returned by `CustomApply.parse_hunks`
+        """
+        diffs = [(_dump_blob(diff.a_blob), _dump_blob(diff.b_blob),
+                  *(getattr(diff, name) for name in _DIFF_FIELDS)) for diff in diff_index]
+        data = pickle.dumps((diffs, hunks), pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+
+        path = self._entry_path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            entries = self._scan()
+            self._size += len(data) - entries.pop(path, 0)
+            entries[path] = len(data)
+            while self._size > self.max_size:
+                oldest = next(iter(entries))
+                self._size -= entries.pop(oldest)
+                self._remove(oldest)
+
+    def _scan(self):
+        if self._entries is None:
+            found = []
+            for directory, _, names in os.walk(self.path):
+                for name in names:
+                    try:
+                        stat = os.stat(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    found.append((stat.st_mtime, os.path.join(directory, name), stat.st_size))
+            self._entries = {path: size for _, path, size in sorted(found)}
+            self._size = sum(self._entries.values())
+        return self._entries
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class PlacementCache:
+    """
+    Where the hunks of file diffs were placed in target files, persisted in an append-only file
+
+    Entries are addressed by `placement_key`, so a changed target file misses naturally, and one cache serves
+    every target synced from a source: identical files of sibling targets share their placements. The file
+    is compacted to the `max_entries` latest placements when it is loaded.
+    """
+
+    def __init__(self, repo: Repo, max_entries=DEFAULT_MAX_PLACEMENTS, path=None):
+        self.path = path or os.path.join(repo.git_dir, "pipe-syncer", "placements")
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> [(position, replace length)] of every hunk, oldest first
+        self._placements = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            key, *placements = line.split(" ")
+            try:
+                parsed = [(int(position), int(length))
+                          for position, length in (placement.split(":") for placement in placements)]
+            except ValueError:
+                # a line cut short by an interrupted run
+                continue
+            self._placements.pop(key, None)
+            self._placements[key] = parsed
+        if len(lines) > self.max_entries:
+            self._compact()
+
+    def _compact(self):
+        keys = list(self._placements)[-self.max_entries:]
+        self._placements = {key: self._placements[key] for key in keys}
+        directory = os.path.dirname(self.path)
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(self._format(key, placements) for key, placements in self._placements.items())
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _format(key, placements):
+        return " ".join([key] + [f"{position}:{length}" for position, length in placements]) + "\n"
+
+    def get(self, key):
+        """
+        :return: (position, replace length) of every hunk of the file diff, or None when it wasn't placed before
+        """
+        with self._lock:
+            return self._placements.get(key)
+
+    def put(self, key, placements):
+        """
+        Remember where every hunk of a file diff was placed
+
+        :param key: key of the placement
+        :param placements: (position, replace length) of every hunk, in the order of the hunks
+        """
+        placements = [tuple(placement) for placement in placements]
+        with self._lock:
+            if self._placements.get(key) == placements:
+                return
+            self._placements[key] = placements
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(self._format(key, placements))
@@ -0,0 +1,169 @@
+import io
+import queue
+import subprocess
+import threading
+
+from git import Commit, Diff, DiffIndex, Repo
+from git.exc import GitCommandError
+
+from utils import exclude_pathspecs
+
+# Lines which can't be parsed as a commit are echoed back by `git diff-tree --stdin` and flushed, the marker
+# can't be mistaken for a patch line because none of them starts with a colon without --raw
+END_MARKER = b"::pipe-syncer-end::\n"
+
+
+class _PatchOutput:
+    """Stand-in for a finished git process so GitPython can parse an already read patch"""
+
+    def __init__(self, patch):
+        self.args = ["git", "diff-tree", "--stdin"]
+        self.stdout = io.BytesIO(patch)
+        self.stderr = None
+
+    def wait(self, **kwargs):
+        return 0
+
+
+class BatchDiffProvider:
+    """
+    Produces patches of many commits through one long-lived `git diff-tree --stdin` process
+
+    Every commit is diffed against its first parent with the same options `sync.py` used for
+    `Commit.diff`, so the result is an equivalent `DiffIndex` without a new git process per commit.
+    Paths starting with one of `exclude_prefixes` are left out by git itself.
+    """
+
+    def __init__(self, repo: Repo, unified=5, ignore_cr_at_eol=True, exclude_prefixes=()):
+        self.repo = repo
+        self.unified = unified
+        self.ignore_cr_at_eol = ignore_cr_at_eol
+        self.exclude_prefixes = list(exclude_prefixes)
+        self._process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _options(self):
+        options = ["--stdin", "--always", "--root", "-r", "-p", "-M", "--abbrev=40",
+                   "--full-index", "--no-ext-diff", "--no-color", f"--unified={self.unified}"]
+        if self.ignore_cr_at_eol:
+            options.append("--ignore-cr-at-eol")
+        if self.exclude_prefixes:
+            options += ["--"] + exclude_pathspecs(self.exclude_prefixes)
+        return options
+
+    def _start(self):
+        if self._process is None:
+            self._process = self.repo.git.diff_tree(*self._options(), as_process=True, istream=subprocess.PIPE)
+        return self._process
+
+    def diff(self, commit: Commit) -> DiffIndex:
+        """
+        Diff the commit against its first parent
+
+        :param commit: commit of the provider repository
+        :return: index of file diffs with patches
+        """
+        process = self._start()
+        request = commit.hexsha
+        if commit.parents:
+            request += f" {commit.parents[0].hexsha}"
+        process.stdin.write(request.encode() + b"\n" + END_MARKER)
+        process.stdin.flush()
+
+        header = process.stdout.readline()
+        if header.strip() != commit.hexsha.encode():
+            self.close()
+            raise GitCommandError(["git", "diff-tree"] + self._options(), "unexpected output", header)
+
+        patch = []
+        for line in iter(process.stdout.readline, b""):
+            if line == END_MARKER:
+                break
+            patch.append(line)
+        else:
+            self.close()
+            raise GitCommandError(["git", "diff-tree"] + self._options(), "exited before the end of the patch")
+
+        return Diff._index_from_patch_format(self.repo, _PatchOutput(b"".join(patch)))
+
+    def iter_diffs(self, commits):
+        """
+        Yield (commit, diff index) pairs as soon as each patch has been read
+
+        :param commits: commits of the provider repository
+        """
+        for commit in commits:
+            yield commit, self.diff(commit)
+
+    def prefetch(self, commits, depth=4, prepare=None):
+        """
+        Yield (commit SHA, prepared diff) pairs in order while a background thread produces the next ones
+
+        The thread reads patches through a provider of its own over a separate `Repo`, as GitPython
+        repositories can't be shared between threads, and runs `prepare` on every diff index. Git latency and
+        the work done by `prepare` for the next commits overlap with whatever the caller does with the
+        current one. Blobs are bound to the repository of this provider before `prepare` gets them, so they
+        are read in the caller's thread.
+
+        :param commits: SHAs of the commits to diff
+        :param depth: number of prepared diffs kept ahead, 0 to produce them on demand without a thread
+        :param prepare: function of a diff index returning what is yielded for it, the index itself by default
+        """
+        commits = list(commits)
+        prepare = prepare or (lambda diff_index: diff_index)
+        if depth < 1:
+            for sha in commits:
+                yield sha, prepare(self.diff(self.repo.commit(sha)))
+            return
+
+        ready = queue.Queue(depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(commits, prepare, ready, stop), daemon=True)
+        producer.start()
+        try:
+            for _ in commits:
+                sha, prepared, error = ready.get()
+                if error is not None:
+                    raise error
+                yield sha, prepared
+        finally:
+            stop.set()
+            producer.join()
+
+    def _produce(self, commits, prepare, ready, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        thread_repo = Repo(self.repo.git_dir)
+        try:
+            with BatchDiffProvider(thread_repo, self.unified, self.ignore_cr_at_eol,
+                                   self.exclude_prefixes) as provider:
+                for sha in commits:
+                    diff_index = provider.diff(thread_repo.commit(sha))
+                    for diff in diff_index:
+                        for blob in (diff.a_blob, diff.b_blob):
+                            if blob is not None:
+                                blob.repo = self.repo
+                    if not put((sha, prepare(diff_index), None)):
+                        return
+        except Exception as e:
+            put((None, None, e))
+        finally:
+            thread_repo.close()
+
+    def close(self):
+        if self._process is not None:
+            process, self._process = self._process, None
+            process.stdin.close()
+            process.wait()
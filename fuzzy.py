@@ -0,0 +1,146 @@
+from collections import Counter
+from typing import NamedTuple, Optional
+
+from line_index import LineIndex
+
+# lines of a hunk found more often than this in the file, like blank lines or braces, don't vote for a position
+MAX_ANCHOR_POSITIONS = 64
+# windows of the file scored for a hunk at most, the ones with the most votes
+MAX_CANDIDATES = 8
+
+
+def normalize(line: bytes) -> bytes:
+    """Line without any whitespace"""
+    return b"".join(line.split())
+
+
+class FuzzyMatch(NamedTuple):
+    """
+    Lines of the target file a hunk was matched with
+
+    `distance` is the number of lines inserted, removed or changed, ignoring whitespace, between the hunk and
+    the file. An already applied match was made with the added lines of the hunk instead of the removed ones.
+    """
+    position: int
+    replace_len: int
+    distance: int
+    already_applied: bool
+
+
+def _align(pattern, text, bound):
+    """
+    Line based edit distance of the pattern from the closest part of the text, bounded
+
+    Only the cells of alignments that can still stay within `bound` are computed, so the cost is linear in
+    the length of the pattern for a given bound.
+
+    :param pattern: lines to look for
+    :param text: lines the pattern is looked for in, extra lines before and after the match are free
+    :param bound: greatest distance accepted
+    :return: (distance, first, last) with the first and last text positions every pattern prefix length is
+        aligned with, or None when the distance exceeds the bound
+    """
+    m, n = len(pattern), len(text)
+    unreachable = bound + 1
+    # text lines in front of the match are free
+    rows = [[0] * (n + 1)]
+    for i in range(1, m + 1):
+        previous = rows[-1]
+        row = [unreachable] * (n + 1)
+        line = pattern[i - 1]
+        low = max(0, i - bound)
+        high = min(n, n - m + i + bound)
+        if low == 0:
+            row[0] = min(i, unreachable)
+            low = 1
+        for j in range(low, high + 1):
+            row[j] = min(previous[j - 1] + (line != text[j - 1]), previous[j] + 1, row[j - 1] + 1, unreachable)
+        if min(row) > bound:
+            return None
+        rows.append(row)
+
+    distance = min(rows[m])
+    if distance > bound:
+        return None
+    # text lines after the match are free as well, the longest match is taken
+    j = max(j for j, value in enumerate(rows[m]) if value == distance)
+    first = [j] * (m + 1)
+    last = [j] * (m + 1)
+    i = m
+    while i > 0:
+        # equal lines are paired first, and a changed line only when no extra or missing one explains it
+        if j > 0 and pattern[i - 1] == text[j - 1] and rows[i][j] == rows[i - 1][j - 1]:
+            i, j = i - 1, j - 1
+            last[i] = j
+        elif j > 0 and rows[i][j] == rows[i][j - 1] + 1:
+            j -= 1
+        elif rows[i][j] == rows[i - 1][j] + 1:
+            i -= 1
+            last[i] = j
+        else:
+            i, j = i - 1, j - 1
+            last[i] = j
+        first[i] = j
+    return distance, first, last
+
+
+class FuzzyMatcher:
+    """
+    Locates the hunks exact search couldn't place in a target file, tolerating differences
+
+    Lines are compared with their whitespace removed. Lines of the hunk are looked up in an index of the
+    normalized file and vote for where the hunk starts, only the windows with the most votes are scored
+    with a line based edit distance, bounded by `threshold` times the number of original lines of the hunk,
+    context included. Frequent lines don't vote, so the search stays linear in the size of the file and of
+    the hunk.
+    """
+
+    def __init__(self, file_index: LineIndex, threshold):
+        self.file_index = file_index
+        self.threshold = threshold
+        # built on the first search, then spliced along with the file index
+        self._normalized = None
+
+    def splice(self, start, length, new_lines):
+        """Follow a splice of the file index"""
+        if self._normalized is not None:
+            self._normalized.splice(start, length, [normalize(line) for line in new_lines])
+
+    def find(self, hunk, expected_position=None) -> Optional[FuzzyMatch]:
+        """
+        :param hunk: `DiffHunk` to locate
+        :param expected_position: expected position of the first replaced line, if known
+        :return: the closest match within the threshold, or None
+        """
+        if self._normalized is None:
+            self._normalized = LineIndex([normalize(line) for line in self.file_index])
+        original_len = len(hunk.before_context) + len(hunk.removed_lines) + len(hunk.after_context)
+        bound = int(original_len * self.threshold)
+
+        best = None
+        for lines, already_applied in ((hunk.removed_lines, False), (hunk.added_lines, True)):
+            pattern = [normalize(line) for line in hunk.before_context + lines + hunk.after_context]
+            if not pattern:
+                continue
+            for start in self._candidates(pattern, expected_position, len(hunk.before_context)):
+                low = max(0, start - bound)
+                aligned = _align(pattern, self._normalized[low:start + len(pattern) + bound], bound)
+                if aligned is None or (best is not None and aligned[0] >= best.distance):
+                    continue
+                distance, first, last = aligned
+                position = low + last[len(hunk.before_context)]
+                end = low + first[len(hunk.before_context) + len(lines)]
+                best = FuzzyMatch(position, max(0, end - position), distance, already_applied)
+        return best
+
+    def _candidates(self, pattern, expected_position, before_len):
+        votes = Counter()
+        for offset, line in enumerate(pattern):
+            positions = self._normalized.positions(line)
+            if len(positions) <= MAX_ANCHOR_POSITIONS:
+                votes.update(position - offset for position in positions)
+        if expected_position is not None:
+            # the position from the hunk header is always scored
+            votes[expected_position - before_len] += 0
+        candidates = sorted(votes, key=lambda start: (-votes[start], abs(start - (expected_position or 0))))
+        return candidates[:MAX_CANDIDATES]
@@ -0,0 +1,132 @@
+import logging
+import textwrap
+from typing import Any, NamedTuple, Tuple
+
+# a hunk was found where its context and removed lines are
+MATCH = 'match'
+# the context of a hunk was found around different lines than the removed ones
+NEAR_MISS = 'near_miss'
+# the added lines of a hunk are already in place
+ALREADY_APPLIED = 'already_applied'
+# a hunk was found nowhere
+UNPLACED = 'unplaced'
+# a hunk was only found once differences were tolerated
+FUZZY_MATCH = 'fuzzy_match'
+# the added lines of a hunk were spliced into the target file, or would be on a dry run
+APPLIED = 'applied'
+
+EVENT_LEVELS = {
+    MATCH: logging.DEBUG,
+    ALREADY_APPLIED: logging.INFO,
+    NEAR_MISS: logging.WARNING,
+    UNPLACED: logging.WARNING,
+    FUZZY_MATCH: logging.WARNING,
+    APPLIED: logging.DEBUG,
+}
+
+
+class HunkEvent(NamedTuple):
+    """
+    Outcome of looking for one hunk of a file diff in the target file
+
+    `position` is the 0-based line the hunk starts replacing at, -1 for an unplaced hunk, and `context` the
+    number of before and after context lines it was matched with. `found_lines` holds the target lines found
+    instead of the removed ones of a near miss or a fuzzy match, and `distance` the number of lines a fuzzy
+    match differs by.
+    """
+    kind: str
+    path: str
+    hunk_id: int
+    hunk: Any
+    position: int = -1
+    context: Tuple[int, int] = (0, 0)
+    found_lines: Tuple[bytes, ...] = ()
+    distance: int = 0
+
+
+def _indent(lines, prefix="| "):
+    if len(lines):
+        return textwrap.indent(b"\n".join(lines).decode(errors='replace'), prefix) + "\n"
+    return ""
+
+
+def render_event(event: HunkEvent):
+    """Multi-line description of the event for humans"""
+    hunk = event.hunk
+    start_len, end_len = event.context
+    where = f"{event.path} hunk {event.hunk_id}"
+    if event.kind == MATCH:
+        return (f"Found match with context for {where} at {event.position}: {start_len}/{end_len}\n"
+                + _indent(hunk.before_context[len(hunk.before_context) - start_len:])
+                + _indent(hunk.removed_lines, " -")
+                + _indent(hunk.added_lines, " +")
+                + _indent(hunk.after_context[:end_len]))
+    if event.kind == NEAR_MISS:
+        return (f"Found potential match for {where}, but content differ, at {event.position}: "
+                f"{start_len}/{end_len}\n"
+                + "Expected:\n" + _indent(hunk.removed_lines)
+                + "Found:\n" + _indent(event.found_lines))
+    if event.kind == APPLIED:
+        return f"Applied change in {event.path} at line {event.position + 1}"
+    if event.kind == FUZZY_MATCH:
+        return (f"Found fuzzy match for {where} at {event.position}, {event.distance} line(s) differ "
+                f"ignoring whitespace\n"
+                + "Expected:\n" + _indent(hunk.removed_lines)
+                + "Found:\n" + _indent(event.found_lines))
+    if event.kind == ALREADY_APPLIED:
+        return (f"Diff already applied for {where} at {event.position}: {start_len}/{end_len}\n"
+                + _indent(hunk.added_lines, " +"))
+    return (f"Couldn't find context for {where}\n"
+            + _indent(hunk.before_context)
+            + _indent(hunk.removed_lines, " -")
+            + _indent(hunk.added_lines, " +")
+            + _indent(hunk.after_context))
+
+
+class NullEventSink:
+    """Drops every event, no event is even created"""
+
+    def wants(self, kind):
+        return False
+
+    def emit(self, event: HunkEvent):
+        pass
+
+
+class LoggingEventSink:
+    """
+    Logs events at the level of their kind, an event is only created and rendered when its level is enabled
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+
+    def wants(self, kind):
+        return self.logger.isEnabledFor(EVENT_LEVELS[kind])
+
+    def emit(self, event: HunkEvent):
+        self.logger.log(EVENT_LEVELS[event.kind], "%s", render_event(event))
+
+
+def logging_event_sink(logger: logging.Logger):
+    """
+    Sink logging the events with the logger, or a `NullEventSink` when the logger is disabled for every event
+    level, like in batch runs logging errors only
+    """
+    if not logger.isEnabledFor(max(EVENT_LEVELS.values())):
+        return NullEventSink()
+    return LoggingEventSink(logger)
+
+
+class RecordingEventSink:
+    """Keeps the events of the given kinds, like the ones a worker process hands back to be emitted"""
+
+    def __init__(self, kinds=frozenset(EVENT_LEVELS)):
+        self.kinds = frozenset(kinds)
+        self.events = []
+
+    def wants(self, kind):
+        return kind in self.kinds
+
+    def emit(self, event: HunkEvent):
+        self.events.append(event)
@@ -0,0 +1,323 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import Sequence
+
+# unchanged parts of a file are copied to the patched one in blocks of this size at most
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class LineIndex:
+    """
+    Hash index over the lines of a target file
+
+    Maps every distinct line to the ascending list of positions it occupies, so hunk context can be
+    located by lookup instead of sliding over the whole file. Slices are tuples, like the lines of a
+    `DiffHunk`.
+
+    The index works as a piece table: the original lines and their positions are never touched, spliced
+    hunks are kept as edits over original line ranges together with the offset they introduce. Lookups
+    translate original positions through the edits, so placing later hunks does not need a rescan, and the
+    patched file is produced by a single merge of the original lines with the edits when it is iterated.
+    """
+
+    def __init__(self, lines):
+        self._lines = lines if isinstance(lines, (tuple, FileLines)) else tuple(lines)
+        self._positions = None
+        # (original start, original end, new lines) sorted by original start, never overlapping
+        self._edits = []
+        self._original_starts = []
+        # current position of every edit and the line offset accumulated up to and including it
+        self._starts = []
+        self._offsets = []
+        # spliced line -> {(original start of its edit, index in the new lines of the edit)}
+        self._inserted = defaultdict(set)
+        self._len = len(self._lines)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        position = 0
+        for (edit_start, edit_end, new_lines) in self._edits:
+            yield from self._lines[position:edit_start]
+            yield from new_lines
+            position = edit_end
+        yield from self._lines[position:]
+
+    def pieces(self):
+        """
+        The patched file as a `range` of original line numbers for every unchanged part and a tuple of lines
+        for every spliced one, in order
+        """
+        position = 0
+        for (edit_start, edit_end, new_lines) in self._edits:
+            if position < edit_start:
+                yield range(position, edit_start)
+            if new_lines:
+                yield new_lines
+            position = edit_end
+        if position < len(self._lines):
+            yield range(position, len(self._lines))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._len)
+            if step != 1:
+                raise ValueError("LineIndex supports only contiguous slices")
+            return self._slice(start, stop)
+
+        if item < 0:
+            item += self._len
+        if not 0 <= item < self._len:
+            raise IndexError("LineIndex index out of range")
+        return self._slice(item, item + 1)[0]
+
+    def positions(self, line):
+        """
+        Ascending positions of the line in the file
+
+        :param line: line content without the line terminator
+        :return: sequence of 0-based line numbers
+        """
+        if self._positions is None:
+            self._positions = defaultdict(list)
+            for idx, file_line in enumerate(self._lines):
+                self._positions[file_line].append(idx)
+
+        original_positions = self._positions.get(line, ())
+        if not self._edits:
+            return original_positions
+
+        result = []
+        for position in original_positions:
+            edit_idx = bisect_right(self._original_starts, position) - 1
+            if edit_idx < 0:
+                result.append(position)
+            elif position >= self._edits[edit_idx][1]:
+                result.append(position + self._offsets[edit_idx])
+            # otherwise the line was replaced by a spliced hunk
+
+        inserted = self._inserted.get(line)
+        if inserted:
+            result.extend(self._starts[bisect_left(self._original_starts, original_start)] + offset
+                          for original_start, offset in inserted)
+            result.sort()
+        return result
+
+    def splice(self, start, length, new_lines):
+        """
+        Replace `length` lines starting at `start` with `new_lines`
+
+        Edits overlapping or touching the replaced range are merged into a single one and only the edits
+        after it are shifted, so the cost doesn't depend on the file length and hunks spliced in file order
+        take constant time besides their own lines.
+        """
+        stop = start + length
+        if not length and not new_lines:
+            return
+
+        # edits never touch each other, at most the one starting last before `start` can reach it
+        first = bisect_right(self._starts, start) - 1
+        if first < 0 or self._starts[first] + len(self._edits[first][2]) < start:
+            first += 1
+        last = bisect_right(self._starts, stop)
+
+        low, high = start, stop
+        if first < last:
+            low = min(low, self._starts[first])
+            high = max(high, self._starts[last - 1] + len(self._edits[last - 1][2]))
+
+        if first < last and low == self._starts[first]:
+            original_start = self._edits[first][0]
+        else:
+            original_start = low - (self._offsets[first - 1] if first else 0)
+        if first < last and high == self._starts[last - 1] + len(self._edits[last - 1][2]):
+            original_end = self._edits[last - 1][1]
+        else:
+            original_end = high - (self._offsets[last - 1] if last else 0)
+
+        merged_lines = self._slice(low, start) + tuple(new_lines) + self._slice(stop, high)
+        for merged_start, _, merged in self._edits[first:last]:
+            for offset, merged_line in enumerate(merged):
+                self._inserted[merged_line].discard((merged_start, offset))
+        for offset, new_line in enumerate(merged_lines):
+            self._inserted[new_line].add((original_start, offset))
+
+        delta = len(new_lines) - length
+        previous_offset = self._offsets[first - 1] if first else 0
+        self._edits[first:last] = [(original_start, original_end, merged_lines)]
+        self._original_starts[first:last] = [original_start]
+        self._starts[first:last] = [low]
+        self._offsets[first:last] = [previous_offset + len(merged_lines) - (original_end - original_start)]
+        for edit_idx in range(first + 1, len(self._edits)):
+            self._starts[edit_idx] += delta
+            self._offsets[edit_idx] += delta
+        self._len += delta
+
+    def _slice(self, start, stop):
+        if not self._edits:
+            return self._lines[start:stop]
+
+        result = []
+        position = start
+        edit_idx = bisect_right(self._starts, position) - 1
+        while position < stop:
+            if edit_idx >= 0:
+                edit_start = self._starts[edit_idx]
+                new_lines = self._edits[edit_idx][2]
+                if position < edit_start + len(new_lines):
+                    chunk = new_lines[position - edit_start:stop - edit_start]
+                    result.extend(chunk)
+                    position += len(chunk)
+                    continue
+                original_position = position - self._offsets[edit_idx]
+            else:
+                original_position = position
+
+            if edit_idx + 1 < len(self._edits):
+                next_start = self._starts[edit_idx + 1]
+            else:
+                next_start = stop
+            end = min(stop, next_start)
+            result.extend(self._lines[original_position:original_position + end - position])
+            position = end
+            if position == next_start:
+                edit_idx += 1
+        return tuple(result)
+
+
+class FileLines(Sequence):
+    """
+    Lines of a file buffer sliced out on access, so a memory-mapped file is never copied as a whole
+
+    Slices are tuples, like the lines of a `DiffHunk`.
+    """
+
+    def __init__(self, content: "FileContent"):
+        self._content = content
+        self._len = content.line_count()
+
+    def __len__(self):
+        return self._len
+
+    def _line(self, idx):
+        content = self._content
+        line = content.data[content.offset(idx):content.offset(idx + 1)]
+        return line.rstrip(b"\n").rstrip(b"\r")
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return tuple(self._line(idx) for idx in range(*item.indices(self._len)))
+        if item < 0:
+            item += self._len
+        if not 0 <= item < self._len:
+            raise IndexError("FileLines index out of range")
+        return self._line(item)
+
+    def __iter__(self):
+        return (self._line(idx) for idx in range(self._len))
+
+    def __reduce__(self):
+        # handed to worker processes as the bytes of the file rather than the mapping
+        return _file_lines, (bytes(self._content.data),)
+
+
+def _file_lines(data):
+    return FileContent(data).lines
+
+
+class FileContent:
+    """
+    Bytes of a target file along with the lines hunks are compared with
+
+    Lines are split on LF only, like git does, and kept without their terminator and trailing CRs, like the
+    lines of a `DiffHunk`. A patched `LineIndex` over them is written by copying the unchanged byte ranges
+    of the file, so their line endings survive as they are. Spliced lines get the line ending of the first
+    line and the file ends with a line ending only if it did before.
+
+    `data` may be a memory-mapped file: its lines are then `FileLines` sliced out of it through an array
+    of line offsets, and unchanged ranges are copied block by block when the file is written. The mapping
+    is closed with the content.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        # a file ending with a line ending, or an empty one, has nothing after its last LF
+        self.final_newline = data[-1:] in (b"", b"\n")
+        first_end = data.find(b"\n")
+        self.eol = b"\r\n" if first_end > 0 and data[first_end - 1] == ord("\r") else b"\n"
+        self._offsets = None
+        if isinstance(data, bytes):
+            lines = data.split(b"\n")
+            if self.final_newline:
+                lines.pop()
+            if b"\r" in data:
+                lines = [line.rstrip(b"\r") for line in lines]
+            self.lines = lines
+        else:
+            self.lines = FileLines(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if not isinstance(self.data, bytes):
+            self.data.close()
+
+    def _line_offsets(self):
+        if self._offsets is None:
+            self._offsets = array('q', [0])
+            position = self.data.find(b"\n")
+            while position != -1:
+                self._offsets.append(position + 1)
+                position = self.data.find(b"\n", position + 1)
+        return self._offsets
+
+    def line_count(self):
+        return len(self._line_offsets()) - (1 if self.final_newline else 0)
+
+    def offset(self, line):
+        """Offset of the first byte of the line, the file size past the last line"""
+        offsets = self._line_offsets()
+        return offsets[line] if line < len(offsets) else len(self.data)
+
+    def chunks(self, file_index: LineIndex):
+        """
+        Content of the file patched as the index, in chunks of bytes
+
+        :param file_index: index created over `lines`, with hunks spliced in
+        """
+        line_count = len(self.lines)
+        last = None
+        for piece in file_index.pieces():
+            if isinstance(piece, range):
+                end = self.offset(piece.stop)
+                for start in range(self.offset(piece.start), end, COPY_BLOCK_SIZE):
+                    if last is not None:
+                        yield last
+                    last = self.data[start:min(start + COPY_BLOCK_SIZE, end)]
+                if piece.stop == line_count and not self.final_newline:
+                    # the last line gets a terminator like every other, the end of the file is fixed below
+                    yield last
+                    last = self.eol
+            else:
+                if last is not None:
+                    yield last
+                last = self.eol.join(piece) + self.eol
+
+        if last is not None:
+            if not self.final_newline:
+                last = last[:-2] if last.endswith(b"\r\n") else last[:-1]
+            yield last
+
+    def render(self, file_index: LineIndex) -> bytes:
+        """
+        Content of the file patched as the index
+
+        :param file_index: index created over `lines`, with hunks spliced in
+        """
+        return b"".join(self.chunks(file_index))
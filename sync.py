@@ -1,127 +1,184 @@
 import argparse
-from itertools import chain
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
-from apply import CustomApply
+from cache import PatchCache, PlacementCache
+from diff_provider import BatchDiffProvider
 from config import log_level, tag_prefix, config, sync_branch_prefix
-from utils import get_latest_semver_tag, find_nearest_common_tag, apply_replacements_to_patch, commit_changes, \
-    create_tag, apply_replacements_to_bytes
-from git import Repo, GitCommandError
-import semver
+from sync_targets import UNIFIED, SyncSource, SyncTarget, load_prepared, prepare_diff, store_prepared, sync_order
+from utils import ThreadLocalStream
+from git import Repo
 import logging
 
-# Set up logging
-logging.basicConfig(level=log_level)
-logger = logging.getLogger(__name__)
-
 parser = argparse.ArgumentParser(description="Sync repositories")
 parser.add_argument("from_repo", help="The source repository name")
-parser.add_argument("to_repo", help="The target repository name")
+parser.add_argument("to_repo", nargs='+',
+                    help="The target repository names, every one of them is synced from the source in a single run")
 parser.add_argument("--range", help="Specific commit range in format 'start_commit..end_commit'", default="")
 parser.add_argument("--interactive", "-i", action=argparse.BooleanOptionalAction)
-args = parser.parse_args()
-
-source_repo_name = args.from_repo
-target_repo_name = args.to_repo
-
-if source_repo_name not in config["repos"] or target_repo_name not in config["repos"]:
-    logger.error("Invalid repository names provided. Please check the configuration.")
-    exit(1)
-
-source_repo_config = config["repos"][source_repo_name]
-target_repo_config = config["repos"][target_repo_name]
-
-source_repo = Repo(source_repo_config["path"])
-target_repo = Repo(target_repo_config["path"])
-custom_apply = CustomApply(
-    target_repo,
-    interactive=args.interactive,
-    replacement_fn=lambda content: apply_replacements_to_bytes(
-        apply_replacements_to_bytes(content, source_repo_config["replacements"], 'source'),
-        target_repo_config["replacements"],
-        'target'
-    )
-)
-source_latest_tag = None
-
-if args.range:
-    logger.debug("Using specified commit range: {}".format(args.range))
-    commits_to_apply = source_repo.git.log(args.range, "--pretty=format:%H").split()
-else:
-    source_latest_tag = get_latest_semver_tag(source_repo, tag_prefix)
-    target_latest_tag = get_latest_semver_tag(target_repo, tag_prefix)
-
-    if not source_latest_tag and not target_latest_tag:
-        logger.error("No semver tags found in both repositories")
+parser.add_argument("--prefetch", type=int, default=4,
+                    help="Number of commits whose patches are prepared ahead in a background thread, 0 to disable")
+parser.add_argument("--workers", type=int, default=0,
+                    help="Number of processes hunks of modified files are searched in, by default a single one")
+parser.add_argument("--cache-size", type=int, default=256,
+                    help="Size in MiB of the on-disk cache of prepared patches reused by later runs, 0 to disable it "
+                         "along with the cache of hunk placements")
+parser.add_argument("--fuzz", type=float, default=0,
+                    help="Fraction of the lines of a hunk, context included, that may differ from the target "
+                         "ignoring whitespace when the hunk isn't found exactly, 0 to only apply exact matches")
+parser.add_argument("--headless", action=argparse.BooleanOptionalAction,
+                    help="Build commits in the object database without touching the working tree, "
+                         "the target may be a bare repository")
+
+
+def run_captured(target, *args):
+    """Apply in a worker thread, collecting what it prints and logs"""
+    with sys.stdout.capture() as out, sys.stderr.capture() as err:
+        try:
+            target.apply(*args)
+            error = None
+        except Exception as e:
+            error = e
+    return out.getvalue(), err.getvalue(), error
+
+
+def main():
+    args = parser.parse_args()
+
+    # Targets are synced concurrently unless the user is asked about every commit, the output of each one is collected
+    # and written out in the order of the targets
+    concurrent = len(args.to_repo) > 1 and not args.interactive
+    if concurrent:
+        sys.stdout = ThreadLocalStream(sys.stdout)
+        sys.stderr = ThreadLocalStream(sys.stderr)
+
+    # Set up logging
+    logging.basicConfig(level=log_level)
+    logger = logging.getLogger(__name__)
+
+    source_repo_name = args.from_repo
+    target_repo_names = list(dict.fromkeys(args.to_repo))
+
+    if any(name not in config["repos"] for name in [source_repo_name] + target_repo_names):
+        logger.error("Invalid repository names provided. Please check the configuration.")
         exit(1)
 
-    if not source_latest_tag or (target_latest_tag and semver.compare(source_latest_tag.name[len(tag_prefix):],
-                                                                      target_latest_tag.name[len(tag_prefix):]) < 0):
-        # Sync from target to source
-        logger.error("Syncing from target is newer than source, please check your config. "
-                     "Source latest: %s Target latest: %s" % (source_latest_tag, target_latest_tag))
+    source_repo_config = config["repos"][source_repo_name]
+    source_repo = Repo(source_repo_config["path"])
+    patch_cache = PatchCache(source_repo, args.cache_size * 1024 * 1024) if args.cache_size > 0 else None
+    placement_cache = PlacementCache(source_repo) if args.cache_size > 0 else None
+    source = SyncSource(source_repo, source_repo_config, len(target_repo_names), args, logger, tag_prefix,
+                        sync_branch_prefix, patch_cache, placement_cache)
+
+    failed = False
+    targets = []
+    for target_repo_name in target_repo_names:
+        target = SyncTarget(source, target_repo_name, config["repos"][target_repo_name])
+        if not target.select_commits():
+            failed = True
+        elif target.commits_to_apply:
+            targets.append(target)
+
+    if not targets:
+        exit(1 if failed else 0)
+
+    commits_in_order = sync_order(source, targets)
+    opened = []
+
+    # Reapply the commits, patches of all of them are produced by a single git process. Patches of the next commits
+    # are read, rewritten and parsed in the background while the current one is applied
+    try:
+        for target in targets:
+            target.open()
+            opened.append(target)
+
+        # commits prepared by a previous run for all the targets which need them aren't diffed again
+        to_diff = []
+        cached = set()
+        for commit_hash in commits_in_order:
+            needed = [target for target in targets if commit_hash in target.pending]
+            if not needed:
+                continue
+            if patch_cache is not None and all(target.cache_key(commit_hash) in patch_cache for target in needed):
+                cached.add(commit_hash)
+            else:
+                to_diff.append(commit_hash)
+
+        # ignored folders of the source never reach the patches, the ones of the target are skipped when applying
+        with BatchDiffProvider(source_repo, unified=UNIFIED, ignore_cr_at_eol=True,
+                               exclude_prefixes=source_repo_config.get("ignore_folders", [])) as diff_provider, \
+                closing(diff_provider.prefetch(to_diff, depth=args.prefetch,
+                                               prepare=lambda diff_index: prepare_diff(source, opened, diff_index))) \
+                as prepared_diffs, \
+                ThreadPoolExecutor(len(targets)) as executor:
+            for commit_hash in commits_in_order:
+                needed = []
+                for target in targets:
+                    if commit_hash in target.pending:
+                        needed.append(target)
+                    elif commit_hash in target.applied_commits:
+                        target.logger.info(f"Commit {commit_hash} already applied, skipping")
+                if not needed:
+                    continue
+
+                if commit_hash in cached:
+                    prepared = load_prepared(source, commit_hash, needed)
+                    if prepared is None:
+                        # the entry is gone since the lookup, like when another run evicted it
+                        prepared = prepare_diff(source, opened, diff_provider.diff(source_repo.commit(commit_hash)))
+                else:
+                    _, prepared = next(prepared_diffs)
+                    store_prepared(source, commit_hash, prepared, opened)
+
+                commit = source_repo.commit(commit_hash)
+                short_message = (commit.message[:75] + '..') if len(commit.message) > 75 else commit.message
+                logger.info(f"Applying commit [{commit_hash}]:\n{short_message}")
+
+                if args.interactive:
+                    user_input = input("Apply commit? [Y]es, [n]o, [a]bort sync: ")
+                    if user_input == 'a':
+                        exit(0)
+                    elif user_input == 'n':
+                        logger.info("Skip applying")
+                        continue
+
+                original_message = commit.message.strip()
+                updated_message = f"{original_message}\n\nOriginal commit: {commit_hash}"
+
+                ready = []
+                for target in needed:
+                    if prepared[target.name][0]:
+                        ready.append(target)
+                    else:
+                        target.logger.info(f"Commit {commit_hash} has no changes outside ignored folders, skipping")
+
+                if not concurrent:
+                    for target in ready:
+                        target.apply(commit_hash, prepared[target.name], updated_message)
+                    continue
+
+                futures = [executor.submit(run_captured, target, commit_hash, prepared[target.name], updated_message)
+                           for target in ready]
+                errors = []
+                for future in futures:
+                    out, err, error = future.result()
+                    sys.stdout.stream.write(out)
+                    sys.stderr.stream.write(err)
+                    if error is not None:
+                        errors.append(error)
+                if errors:
+                    raise errors[0]
+    finally:
+        for target in opened:
+            target.close()
+
+    for target in targets:
+        target.tag()
+
+    if failed:
         exit(1)
 
-    # Get every commit from the source repo since the latest synced tag
-    common_tag = find_nearest_common_tag(source_repo, target_repo, tag_prefix)
-    logger.debug(
-        "Getting commits to apply since the "
-        "latest synced tag: %s till: %s" % (common_tag.name, source_latest_tag.name)
-    )
-    commits_to_apply = source_repo.git.log(f"{common_tag.commit.hexsha}..{source_latest_tag.commit.hexsha}",
-                                           "--pretty=format:%H").split()
-
-if len(commits_to_apply) < 1:
-    exit(0)
-
-latest_commit_to_apply = commits_to_apply[-1]
-source_short_hash = source_repo.git.rev_parse(latest_commit_to_apply, short=True)
-SYNC_BRANCH_NAME = f"{sync_branch_prefix}-{source_short_hash}"
-try:
-    sync_branch = target_repo.create_head(SYNC_BRANCH_NAME)
-except GitCommandError:
-    sync_branch = target_repo.heads[SYNC_BRANCH_NAME]
-
-target_repo.head.reference = sync_branch
-applied_commits = {
-    commit.message.split("Original commit: ")[-1].strip()
-    for commit in chain([sync_branch.commit], sync_branch.commit.iter_parents())
-    if "Original commit: " in commit.message
-}
-
-# Reapply the commits
-for commit_hash in reversed(commits_to_apply):
-    if commit_hash in applied_commits:
-        logger.info(f"Commit {commit_hash} already applied, skipping")
-        continue
-
-    commit = source_repo.commit(commit_hash)
-    short_message = (commit.message[:75] + '..') if len(commit.message) > 75 else commit.message
-    logger.info(f"Applying commit [{commit_hash}]:\n{short_message}")
-
-    if args.interactive:
-        user_input = input("Apply commit? [Y]es, [n]o, [a]bort sync: ")
-        if user_input == 'a':
-            exit(0)
-        elif user_input == 'n':
-            logger.info("Skip applying")
-            continue
-
-    diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True, unified=5)
-    diff = apply_replacements_to_patch(diff, source_repo_config["replacements"], 'source')
-    diff = apply_replacements_to_patch(diff, target_repo_config["replacements"], 'target')
-
-    original_message = commit.message.strip()
-    updated_message = f"{original_message}\n\nOriginal commit: {commit_hash}"
-
-    # Apply the diff using the CustomApply class
-    if custom_apply.apply(diff):
-        logger.info(f"Applied commit {commit_hash} to target repo")
-        target_repo.git.add(".")
-        commit_changes(target_repo, updated_message)
-    else:
-        logger.error(f"Can't apply commit {commit_hash} to target repo. \nManually applied patch should be committed "
-                     f"with message: \n========================\n{updated_message}\n========================")
-
-if source_latest_tag:
-    tag_message = f"Synced commit tagged with source repo tag: {source_latest_tag.name}"
-    create_tag(logger, target_repo, source_latest_tag.name, tag_message)
+
+if __name__ == "__main__":
+    main()
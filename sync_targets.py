@@ -0,0 +1,256 @@
+import copy
+import logging
+
+import semver
+from git import Blob, DiffIndex, GitCommandError, Repo
+
+from applied_index import AppliedCommitIndex
+from apply import CustomApply
+from cache import patch_cache_key
+from hunk_events import logging_event_sink
+from target_store import ObjectStore, WorktreeStore
+from utils import ReplacementRewriter, TagIndex, apply_replacements_to_patch, create_tag, replacement_rules
+
+# context lines of the source patches
+UNIFIED = 5
+
+
+class SyncSource:
+    """
+    Source repository of a run along with what all of its targets share: the source stage of the replacements,
+    the tags, the caches and the options of the run
+    """
+
+    def __init__(self, repo: Repo, repo_config, target_count, options, logger: logging.Logger, tag_prefix,
+                 sync_branch_prefix, patch_cache=None, placement_cache=None):
+        """
+        :param repo: source repository
+        :param repo_config: configuration of the source repository
+        :param target_count: number of targets synced in the run
+        :param options: parsed command line arguments: range, interactive, headless, workers and fuzz
+        :param logger: logger of the run, targets log under a child of it named after them
+        """
+        self.config = repo_config
+        self.repo = repo
+        self.rules = replacement_rules(repo_config["replacements"], 'source')
+        self.target_count = target_count
+        # With a single target source replacements are reverted and target ones applied in one composed rewriter.
+        # With several of them the source stage is shared and every target runs its own stage on a copy of the
+        # patches
+        self.rewriter = ReplacementRewriter(self.rules if target_count > 1 else [])
+        self.options = options
+        # Targets are synced concurrently unless the user is asked about every commit
+        self.concurrent = target_count > 1 and not options.interactive
+        self.logger = logger
+        self.tag_prefix = tag_prefix
+        self.sync_branch_prefix = sync_branch_prefix
+        self.tags = None if options.range else TagIndex(self.repo, tag_prefix)
+        self.patch_cache = patch_cache
+        # where hunks landed in target files, shared by all the targets
+        self.placement_cache = placement_cache
+
+
+class SyncTarget:
+    """
+    State of syncing the source repository into one target: the commits it needs, its sync branch and stores
+    """
+
+    def __init__(self, source: SyncSource, name, repo_config):
+        self.source = source
+        self.name = name
+        self.config = repo_config
+        self.repo = Repo(self.config["path"])
+        self.logger = source.logger.getChild(name)
+        target_rules = replacement_rules(self.config["replacements"], 'target')
+        # created files are rewritten whole, so both stages always apply to them
+        self.rewriter = ReplacementRewriter(source.rules + target_rules)
+        self.patch_rewriter = ReplacementRewriter(target_rules) if source.target_count > 1 else self.rewriter
+        # blobs are read from the thread the target is synced in, each one needs its own git processes
+        self.source_repo = Repo(source.repo.git_dir) if source.concurrent else source.repo
+        self.source_latest_tag = None
+        # target commit of the latest common tag, commits applied before it can't be synced again
+        self.applied_since = None
+        # source commit the synced range starts after, None for an explicit range
+        self.range_start = None
+        self.commits_to_apply = []
+
+    def select_commits(self):
+        """
+        Find the source commits to sync since the latest common tag
+
+        :return: False when the repositories can't be synced
+        """
+        source = self.source
+        tag_prefix = source.tag_prefix
+        if source.options.range:
+            self.logger.debug("Using specified commit range: {}".format(source.options.range))
+            self.commits_to_apply = source.repo.git.log(source.options.range, "--pretty=format:%H").split()
+            return True
+
+        # tags of both repositories are read and parsed once
+        target_tags = TagIndex(self.repo, tag_prefix)
+        source_latest_tag = source.tags.latest()
+        target_latest_tag = target_tags.latest()
+
+        if not source_latest_tag and not target_latest_tag:
+            self.logger.error("No semver tags found in both repositories")
+            return False
+
+        if not source_latest_tag or (target_latest_tag and
+                                     semver.compare(source_latest_tag.name[len(tag_prefix):],
+                                                    target_latest_tag.name[len(tag_prefix):]) < 0):
+            # Sync from target to source
+            self.logger.error("Syncing from target is newer than source, please check your config. "
+                              "Source latest: %s Target latest: %s" % (source_latest_tag, target_latest_tag))
+            return False
+
+        # Get every commit from the source repo since the latest synced tag
+        common_tag = source.tags.common(target_tags)
+        self.logger.debug(
+            "Getting commits to apply since the "
+            "latest synced tag: %s till: %s" % (common_tag.name, source_latest_tag.name)
+        )
+        self.source_latest_tag = source_latest_tag
+        self.applied_since = target_tags.commit_sha(common_tag.name)
+        self.range_start = source.tags.commit_sha(common_tag.name)
+        self.commits_to_apply = source.repo.git.log(f"{self.range_start}.."
+                                                    f"{source.tags.commit_sha(source_latest_tag.name)}",
+                                                    "--pretty=format:%H").split()
+        return True
+
+    def open(self):
+        source = self.source
+        latest_commit_to_apply = self.commits_to_apply[-1]
+        source_short_hash = source.repo.git.rev_parse(latest_commit_to_apply, short=True)
+        sync_branch_name = f"{source.sync_branch_prefix}-{source_short_hash}"
+        try:
+            self.sync_branch = self.repo.create_head(sync_branch_name)
+        except GitCommandError:
+            self.sync_branch = self.repo.heads[sync_branch_name]
+
+        if source.options.headless:
+            # the sync branch is moved once all commits are written
+            self.store = ObjectStore(self.repo, self.sync_branch.commit)
+        else:
+            self.repo.head.reference = self.sync_branch
+            self.store = WorktreeStore(self.repo)
+        self.custom_apply = CustomApply(
+            self.repo,
+            interactive=source.options.interactive,
+            replacement_fn=self.rewriter,
+            store=self.store,
+            ignore_prefixes=self.config.get("ignore_folders", []),
+            workers=source.options.workers,
+            placements=source.placement_cache,
+            fuzz=source.options.fuzz,
+            # hunk search events are logged at the configured level under the name of the target, and not even
+            # created when that level is above all of theirs
+            events=logging_event_sink(self.logger)
+        )
+        # only commits added to the target since the previous run are read
+        self.applied_index = AppliedCommitIndex(self.repo)
+        self.applied_commits = self.applied_index.update(self.sync_branch.commit.hexsha, self.applied_since)
+        self.pending = {commit_hash for commit_hash in self.commits_to_apply
+                        if commit_hash not in self.applied_commits}
+
+    def cache_key(self, commit_hash):
+        return patch_cache_key(commit_hash, self.rewriter.rules, UNIFIED, self.source.config.get("ignore_folders", []),
+                               self.config.get("ignore_folders", []))
+
+    def prepare(self, diff_index, shared=False):
+        """
+        Rewrite the patches with the stage of the target and parse them
+
+        :param diff_index: patches rewritten by the source stage
+        :param shared: whether other targets prepare the same patches, they are then rewritten on a copy
+        """
+        if shared or self.source_repo is not self.source.repo:
+            diff_index = DiffIndex(self._copy(diff) for diff in diff_index)
+        diff_index = apply_replacements_to_patch(diff_index, self.patch_rewriter)
+        return diff_index, self.custom_apply.parse_hunks(diff_index)
+
+    def _copy(self, diff):
+        # patches are rewritten in place and blobs are read through the repository they are bound to
+        diff = copy.copy(diff)
+        for attr in ('a_blob', 'b_blob'):
+            blob = getattr(diff, attr)
+            if blob is not None:
+                setattr(diff, attr, Blob(self.source_repo, blob.binsha, blob.mode, blob.path))
+        return diff
+
+    def apply(self, commit_hash, prepared, updated_message):
+        diff, hunks = prepared
+        # Apply the diff using the CustomApply class
+        apply_result = self.custom_apply.apply(diff, hunks)
+        if apply_result:
+            self.logger.info(f"Applied commit {commit_hash} to target repo")
+            self.store.commit(updated_message, apply_result.touched_paths)
+        elif self.source.options.headless:
+            self.store.reset()
+            self.logger.error(f"Can't apply commit {commit_hash} to target repo, its changes are dropped. "
+                              f"Apply it without --headless to fix it manually.")
+        else:
+            self.logger.error(f"Can't apply commit {commit_hash} to target repo. \nManually applied patch should be "
+                              f"committed with message: \n========================\n{updated_message}\n"
+                              f"========================")
+
+    def close(self):
+        self.custom_apply.close()
+        if self.source.options.headless:
+            self.sync_branch.commit = self.store.head
+        self.applied_index.update(self.sync_branch.commit.hexsha, self.applied_since)
+
+    def tag(self):
+        if self.source_latest_tag:
+            tag_message = f"Synced commit tagged with source repo tag: {self.source_latest_tag.name}"
+            create_tag(self.logger, self.repo, self.source_latest_tag.name, tag_message, ref=self.sync_branch)
+
+
+def sync_order(source: SyncSource, targets):
+    """
+    Source commits needed by any of the targets, oldest first
+
+    :return: list of SHAs in the order `git log` walks them, reversed
+    """
+    commit_lists = {tuple(target.commits_to_apply) for target in targets}
+    if len(commit_lists) == 1:
+        return list(reversed(next(iter(commit_lists))))
+
+    # ranges differ by the common tag they start after only, the union is walked once down to the ancestor
+    # shared by all of those tags
+    wanted = set().union(*commit_lists)
+    tips = {commits[0] for commits in commit_lists}
+    try:
+        common_bases = source.repo.git.merge_base("--octopus", *{target.range_start for target in targets}).split()
+    except GitCommandError:
+        # the ranges share no history
+        common_bases = []
+    walked = source.repo.git.log(*tips, *[f"^{base}" for base in common_bases], "--pretty=format:%H").split()
+    return [commit_hash for commit_hash in reversed(walked) if commit_hash in wanted]
+
+
+def prepare_diff(source: SyncSource, targets, diff_index):
+    """
+    Prepare the patches of a commit for every target
+
+    :return: target name -> (rewritten diff index, hunks)
+    """
+    # the source stage runs once, every target rewrites and parses its own copy
+    diff_index = apply_replacements_to_patch(diff_index, source.rewriter)
+    return {target.name: target.prepare(diff_index, shared=len(targets) > 1) for target in targets}
+
+
+def load_prepared(source: SyncSource, commit_hash, targets):
+    """Prepared patches of the commit for every one of the targets from the cache, None on a miss"""
+    prepared = {}
+    for target in targets:
+        prepared[target.name] = source.patch_cache.get(target.cache_key(commit_hash), target.source_repo)
+        if prepared[target.name] is None:
+            return None
+    return prepared
+
+
+def store_prepared(source: SyncSource, commit_hash, prepared, targets):
+    if source.patch_cache is not None:
+        for target in targets:
+            source.patch_cache.put(target.cache_key(commit_hash), *prepared[target.name])
@@ -0,0 +1,352 @@
+import hashlib
+import io
+import mmap
+import os
+import stat
+import tempfile
+
+from git import Commit, IndexFile, Repo
+from git.objects import Tree
+from git.objects.fun import tree_entries_from_data, tree_to_stream
+from gitdb import IStream
+
+from utils import commit_changes, stage_paths
+
+# mode `git add` gives to a new regular file
+FILE_MODE = 0o100644
+TREE_MODE = 0o040000
+# blobs up to this size are buffered in memory before they are written to the object database
+SPOOL_SIZE = 1024 * 1024
+# worktree files from this size on are memory-mapped instead of read
+MAP_SIZE = 1024 * 1024
+
+
+class WorktreeStore:
+    """
+    Target files in the working tree of a repository
+
+    Changes are staged and committed with git, a failed commit is left in the working tree to be fixed
+    manually.
+    """
+
+    def __init__(self, repo: Repo):
+        self.repo = repo
+        # read on first use and again after every commit, which stages the written files
+        self._index = None
+
+    def _path(self, path):
+        return os.path.join(self.repo.working_dir, path)
+
+    def exists(self, path):
+        return os.path.exists(self._path(path))
+
+    def open(self, path, mode='r'):
+        """
+        Open a file of the working tree, an existing file opened for writing is only replaced once it is closed
+        """
+        file_path = self._path(path)
+        if 'r' not in mode:
+            if os.path.isfile(file_path):
+                return _ReplacingWriter(file_path, mode)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return open(file_path, mode)
+
+    def read(self, path):
+        """
+        :return: content of the file, memory-mapped when it is large, the caller closes the mapping
+        """
+        with open(self._path(path), 'rb') as f:
+            if os.fstat(f.fileno()).st_size < MAP_SIZE:
+                return f.read()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def known_blob_sha(self, path):
+        """
+        SHA of the file blob taken from the index without reading the file, when the file is clean
+
+        A file is clean when its size and modification time are the ones of its index entry. Like git, a file
+        modified after the index was written is not trusted, its change could have been too quick to be seen.
+
+        :return: the SHA, or None when the file has to be read to know it
+        """
+        if self._index is None:
+            self._index = IndexFile(self.repo)
+        entry = self._index.entries.get((path, 0))
+        if entry is None:
+            return None
+        try:
+            file_stat = os.stat(self._path(path))
+        except FileNotFoundError:
+            return None
+        seconds, nanoseconds = entry.mtime
+        if (file_stat.st_size != entry.size or file_stat.st_mtime_ns != seconds * 10 ** 9 + nanoseconds
+                or file_stat.st_mtime_ns >= os.stat(self._index.path).st_mtime_ns):
+            return None
+        return entry.hexsha
+
+    def blob_sha(self, path):
+        """SHA the file has as a git blob"""
+        blob_sha = self.known_blob_sha(path)
+        if blob_sha is not None:
+            return blob_sha
+        file_path = self._path(path)
+        digest = hashlib.sha1(b"blob %d\0" % os.path.getsize(file_path))
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(SPOOL_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def remove(self, path):
+        os.remove(self._path(path))
+
+    def rename(self, old_path, new_path):
+        os.rename(self._path(old_path), self._path(new_path))
+
+    def commit(self, message, touched_paths):
+        stage_paths(self.repo, touched_paths)
+        self._index = None
+        # other changes left in the working tree, like the ones of a commit which failed to apply, aren't staged
+        # and would make `git commit` fail when the touched paths didn't change
+        if not self.repo.is_dirty(index=True, working_tree=False):
+            print('No changes to commit, skipping...')
+            return
+        commit_changes(self.repo, message)
+
+    def reset(self):
+        pass
+
+
+class _ReplacingWriter:
+    """
+    Writable file which replaces an existing file when it is closed, keeping its permissions
+
+    The content is written next to the file and renamed over it, so the old content, even a memory-mapped
+    one, stays readable while the new one is written.
+    """
+
+    def __init__(self, path, mode):
+        self._path = path
+        fd, self._temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".pipe-syncer-")
+        os.chmod(self._temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        self._file = os.fdopen(fd, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._temp_path)
+
+    def write(self, data):
+        return self._file.write(data)
+
+    def writelines(self, lines):
+        self._file.writelines(lines)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            os.replace(self._temp_path, self._path)
+
+
+class _BlobWriter:
+    """Writable file which is stored as a blob of the `ObjectStore` when it is closed"""
+
+    def __init__(self, store, path):
+        self._store = store
+        self._path = path
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._buffer.close()
+
+    def write(self, data):
+        return self._buffer.write(data)
+
+    def writelines(self, lines):
+        self._buffer.writelines(lines)
+
+    def close(self):
+        if not self._buffer.closed:
+            size = self._buffer.tell()
+            self._buffer.seek(0)
+            self._store._write_blob(self._path, self._buffer, size)
+            self._buffer.close()
+
+
+def _tree_order(item):
+    # git sorts tree entries by name as if directories had a trailing slash
+    name, (mode, _) = item
+    return name.encode() + (b"/" if mode == TREE_MODE else b"")
+
+
+def _cleanup_message(message):
+    # the whitespace cleanup `git commit -m` does
+    lines = [line.rstrip() for line in message.strip().splitlines()]
+    return "\n".join(line for idx, line in enumerate(lines) if line or lines[idx - 1]) + "\n"
+
+
+class ObjectStore:
+    """
+    Target files in the object database of a repository, no working tree is read or written
+
+    Files are read from the tree of the last commit and written as blobs right away. A commit writes the
+    trees of changed directories only and is chained onto the previous one in memory, so a branch can be
+    moved to the last of them once. Works with bare repositories.
+    """
+
+    def __init__(self, repo: Repo, base: Commit):
+        self.repo = repo
+        self.head = base
+        self.reset()
+
+    def _tree(self, dir_path, create=False):
+        """Entries {name: (mode, binsha)} of the directory, loaded on first use"""
+        if dir_path in self._trees:
+            return self._trees[dir_path]
+
+        if dir_path:
+            parent_path, _, name = dir_path.rpartition('/')
+            parent = self._tree(parent_path, create)
+            if parent is None:
+                return None
+            entry = parent.get(name)
+            if entry is not None and entry[0] != TREE_MODE:
+                entry = None
+            if entry is None and not create:
+                return None
+        else:
+            entry = (TREE_MODE, self.head.tree.binsha)
+
+        entries = {}
+        if entry is not None:
+            data = self.repo.odb.stream(entry[1]).read()
+            entries = {name: (mode, binsha) for binsha, mode, name in tree_entries_from_data(data)}
+        self._trees[dir_path] = entries
+        return entries
+
+    def _entry(self, path):
+        dir_path, _, name = path.rpartition('/')
+        entries = self._tree(dir_path)
+        return None if entries is None else entries.get(name)
+
+    def _set_entry(self, path, entry):
+        dir_path, _, name = path.rpartition('/')
+        self._tree(dir_path, create=True)[name] = entry
+        self._touch(dir_path)
+
+    def _touch(self, dir_path):
+        while dir_path not in self._dirty:
+            self._dirty.add(dir_path)
+            if not dir_path:
+                break
+            dir_path = dir_path.rpartition('/')[0]
+
+    def exists(self, path):
+        return self._entry(path) is not None
+
+    def open(self, path, mode='r'):
+        if 'r' in mode:
+            entry = self._entry(path)
+            if entry is None or entry[0] == TREE_MODE:
+                raise FileNotFoundError(path)
+            content = io.BytesIO(self.repo.odb.stream(entry[1]).read())
+            return content if 'b' in mode else io.TextIOWrapper(content)
+
+        if 'b' not in mode:
+            raise ValueError("ObjectStore files can only be written in binary mode")
+        return _BlobWriter(self, path)
+
+    def read(self, path):
+        """
+        :return: content of the file blob
+        """
+        with self.open(path, 'rb') as f:
+            return f.read()
+
+    def known_blob_sha(self, path):
+        """SHA of the file blob, every blob is known from its tree"""
+        return self.blob_sha(path)
+
+    def blob_sha(self, path):
+        """SHA of the file blob, taken from its tree without reading the blob"""
+        entry = self._entry(path)
+        if entry is None or entry[0] == TREE_MODE:
+            raise FileNotFoundError(path)
+        return entry[1].hex()
+
+    def _write_blob(self, path, stream, size):
+        binsha = self.repo.odb.store(IStream(b"blob", size, stream)).binsha
+        entry = self._entry(path)
+        # like a rewritten file, an existing blob keeps its mode
+        mode = entry[0] if entry is not None and entry[0] != TREE_MODE else FILE_MODE
+        self._set_entry(path, (mode, binsha))
+
+    def remove(self, path):
+        entry = self._entry(path)
+        if entry is None:
+            raise FileNotFoundError(path)
+        dir_path, _, name = path.rpartition('/')
+        del self._trees[dir_path][name]
+        self._touch(dir_path)
+
+    def rename(self, old_path, new_path):
+        entry = self._entry(old_path)
+        if entry is None:
+            raise FileNotFoundError(old_path)
+        if entry[0] == TREE_MODE:
+            raise IsADirectoryError(old_path)
+        self.remove(old_path)
+        self._set_entry(new_path, entry)
+
+    def _write_tree(self, entries):
+        stream = io.BytesIO()
+        tree_to_stream([(binsha, mode, name) for name, (mode, binsha) in sorted(entries.items(), key=_tree_order)],
+                       stream.write)
+        size = stream.tell()
+        stream.seek(0)
+        return self.repo.odb.store(IStream(b"tree", size, stream)).binsha
+
+    def commit(self, message, touched_paths=()):
+        """
+        Write the trees of changed directories and a commit of the root tree on top of the last commit
+
+        :param message: commit message
+        :param touched_paths: unused, all changes made since the last commit are committed
+        :return: the new commit or None when nothing changed
+        """
+        root = self.head.tree.binsha
+        # children first, a directory left empty is dropped from its parent like git does
+        for dir_path in sorted(self._dirty, key=lambda path: path.count('/') + bool(path), reverse=True):
+            binsha = self._write_tree(self._trees[dir_path])
+            if not dir_path:
+                root = binsha
+                continue
+            parent_path, _, name = dir_path.rpartition('/')
+            if self._trees[dir_path]:
+                self._trees[parent_path][name] = (TREE_MODE, binsha)
+            else:
+                self._trees[parent_path].pop(name, None)
+        self._dirty.clear()
+
+        if root == self.head.tree.binsha:
+            print('No changes to commit, skipping...')
+            return None
+
+        self.head = Commit.create_from_tree(self.repo, Tree(self.repo, root), _cleanup_message(message),
+                                            parent_commits=[self.head], head=False)
+        return self.head
+
+    def reset(self):
+        """Drop the changes made since the last commit"""
+        self._trees = {}
+        self._dirty = set()
@@ -0,0 +1,60 @@
+import shutil
+import tempfile
+import unittest
+
+from git import Repo
+
+from applied_index import AppliedCommitIndex
+
+
+class TestAppliedCommitIndex(unittest.TestCase):
+    def setUp(self):
+        self.repo = Repo.init(tempfile.mkdtemp())
+        self.repo.index.commit("Initial commit")
+
+    def commit(self, source_sha=None):
+        message = "Synced change" if source_sha is None else f"Synced change\n\nOriginal commit: {source_sha}"
+        return self.repo.index.commit(message).hexsha
+
+    def test_update_is_incremental(self):
+        first = self.commit("a" * 40)
+        self.commit()
+        tip = self.commit("b" * 40)
+
+        self.assertEqual({"a" * 40: first, "b" * 40: tip}, AppliedCommitIndex(self.repo).update(tip))
+
+        newest = self.commit("c" * 40)
+        index = AppliedCommitIndex(self.repo)
+        self.assertEqual(tip, index.tip)
+        # an incremental update must not need the history below the indexed tip
+        index.commits.pop("a" * 40)
+
+        self.assertEqual({"b" * 40: tip, "c" * 40: newest}, index.update(newest))
+
+    def test_rebuild_when_tip_is_not_an_ancestor(self):
+        base = self.repo.head.commit
+        tip = self.commit("a" * 40)
+        AppliedCommitIndex(self.repo).update(tip)
+
+        self.repo.head.reset(base)
+        other = self.commit("b" * 40)
+
+        self.assertEqual({"b" * 40: other}, AppliedCommitIndex(self.repo).update(other))
+
+    def test_update_is_bounded(self):
+        first = self.commit("a" * 40)
+        since = self.commit()
+        tip = self.commit("b" * 40)
+
+        self.assertEqual({"b" * 40: tip}, AppliedCommitIndex(self.repo).update(tip, since))
+        # an index bounded by a later commit can't serve the whole history
+        self.assertEqual({"a" * 40: first, "b" * 40: tip}, AppliedCommitIndex(self.repo).update(tip))
+
+    def test_last_marker_wins(self):
+        tip = self.repo.index.commit(f"Synced change\n\nOriginal commit: {'a' * 40}\n\n"
+                                     f"Original commit: {'b' * 40}\n").hexsha
+
+        self.assertEqual({"b" * 40: tip}, AppliedCommitIndex(self.repo).update(tip))
+
+    def tearDown(self):
+        shutil.rmtree(self.repo.working_tree_dir)
@@ -1,13 +1,21 @@
+import multiprocessing
 import os
 import shutil
+import stat
 import tempfile
 import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
 
 import pytest
 from git import Repo
 from parameterized import parameterized
 
-from apply import CustomApply
+from apply import CustomApply, _patch_in_worker, iter_diff_hunks
+from cache import PlacementCache
+from hunk_events import APPLIED, FUZZY_MATCH, MATCH, NEAR_MISS, UNPLACED, NullEventSink, RecordingEventSink
+from target_store import WorktreeStore
+from utils import ReplacementRewriter
 
 
 def init_test_repos():
@@ -54,7 +62,9 @@ class TestCustomApply(unittest.TestCase):
 
         # Apply the diff using the CustomApply class
         custom_apply = CustomApply(self.target_repo)
-        custom_apply.apply(diff)
+        result = custom_apply.apply(diff)
+        self.assertTrue(result)
+        self.assertEqual({'new_file.txt'}, result.touched_paths)
 
         # Assert that the new file exists in the target repo and has the same content
         new_file_target_path = os.path.join(self.target_repo.working_tree_dir, 'new_file.txt')
@@ -63,10 +73,49 @@ class TestCustomApply(unittest.TestCase):
             target_content = f.read()
         self.assertEqual(new_file_content, target_content, "New file content should match")
 
+    def test_handle_create_streams_replacements(self):
+        new_file_content = "import com.pipeline.Config\n" * 50
+        create_and_commit_file(self.source_repo, 'new_file.txt', new_file_content, "Add new file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+        rewriter = ReplacementRewriter([(b"com.pipeline", b"com.insly")])
+        CustomApply(self.target_repo, replacement_fn=rewriter, chunk_size=7).apply(diff)
+
+        with open(os.path.join(self.target_repo.working_tree_dir, 'new_file.txt'), 'r') as f:
+            self.assertEqual("import com.insly.Config\n" * 50, f.read())
+
+    def test_ignored_files_are_skipped(self):
+        os.makedirs(os.path.join(self.source_repo.working_tree_dir, 'jobs'))
+        create_and_commit_file(self.source_repo, 'jobs/job.groovy', "job\n", "Add job")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+        result = CustomApply(self.target_repo, ignore_prefixes=['.helm/', 'jobs/']).apply(diff)
+
+        self.assertTrue(result)
+        self.assertEqual(frozenset(), result.touched_paths)
+        self.assertFalse(os.path.exists(os.path.join(self.target_repo.working_tree_dir, 'jobs')))
+
+    def test_handle_create_copies_binary_file(self):
+        content = bytes(range(256)) * 4 + b"com.pipeline"
+        with open(os.path.join(self.source_repo.working_tree_dir, 'image.bin'), 'wb') as f:
+            f.write(content)
+        self.source_repo.index.add(['image.bin'])
+        self.source_repo.index.commit("Add binary file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+        rewriter = ReplacementRewriter([(b"com.pipeline", b"com.insly")])
+        CustomApply(self.target_repo, replacement_fn=rewriter).apply(diff)
+
+        with open(os.path.join(self.target_repo.working_tree_dir, 'image.bin'), 'rb') as f:
+            self.assertEqual(content, f.read())
+
     @parameterized.expand([
         (
                 'multiple hunks',
-                'Applied change in file.txt at line 22\nApplied change in file.txt at line 92',
+                [22, 92],
 
                 "".join([f"Line {idx}\n" for idx in range(1, 20)])
                 + 'Line 20\nLine 21\nModified Line 23\n'
@@ -82,7 +131,7 @@ class TestCustomApply(unittest.TestCase):
         ),
         (
                 'diff in both ends of the file',
-                'Applied change in file.txt at line 3\nApplied change in file.txt at line 9',
+                [3, 9],
 
                 'Line 1\nLine 2\nModified Line 3\n'
                 + "".join([f"Line {idx}\n" for idx in range(4, 9)])
@@ -96,7 +145,7 @@ class TestCustomApply(unittest.TestCase):
         ),
         (
                 'partial match additional content',
-                'Applied change in file.txt at line 3',
+                [3, 10],
 
                 'Line 1\nLine 2\nModified Line 3\n'
                 + "".join([f"Line {idx}\n" for idx in range(4, 10)]),
@@ -109,7 +158,7 @@ class TestCustomApply(unittest.TestCase):
         ),
         (
                 'partial front match single line',
-                'Applied change in file.txt at line 2',
+                [2, 10],
                 'Line 1\nModified Line 2\n'
                 + "".join([f"Line {idx}\n" for idx in range(3, 10)]),
 
@@ -120,7 +169,7 @@ class TestCustomApply(unittest.TestCase):
         ),
         (
                 'full match single line',
-                'Applied change in file.txt at line 3',
+                [3, 10],
 
                 'Line 1\nLine 2\nModified Line 3\n'
                 + "".join([f"Line {idx}\n" for idx in range(4, 10)]),
@@ -130,8 +179,24 @@ class TestCustomApply(unittest.TestCase):
                 'Line 1\nLine 2\nModified Line 3\n'
                 + "".join([f"Line {idx}\n" for idx in range(4, 10)]),
         ),
+        (
+                'already applied',
+                [50],
+
+                "".join([f"Line {idx}\n" for idx in range(1, 50)])
+                + 'Modified Line 50\nAdded Line 50\n'
+                + "".join([f"Line {idx}\n" for idx in range(51, 100)]),
+
+                "".join([f"Line {idx}\n" for idx in range(1, 50)])
+                + 'Modified Line 50\nAdded Line 50\n'
+                + "".join([f"Line {idx}\n" for idx in range(51, 100)]),
+
+                "".join([f"Line {idx}\n" for idx in range(1, 50)])
+                + 'Modified Line 50\nAdded Line 50\n'
+                + "".join([f"Line {idx}\n" for idx in range(51, 100)]),
+        ),
     ])
-    def test_handle_modify(self, name, expected_output, source_content, target_content, expected_target_content):
+    def test_handle_modify(self, name, expected_lines, source_content, target_content, expected_target_content):
         create_and_commit_file(self.source_repo, 'file.txt', source_content, "Modify file")
         create_and_commit_file(self.target_repo, 'file.txt', target_content, "Add extra line")
 
@@ -140,10 +205,13 @@ class TestCustomApply(unittest.TestCase):
         diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
 
         # Apply the diff using the CustomApply class
-        custom_apply = CustomApply(self.target_repo)
+        events = RecordingEventSink([APPLIED])
+        custom_apply = CustomApply(self.target_repo, events=events)
         custom_apply.apply(diff)
-        output, err = self.capfd.readouterr()  # https://github.com/pytest-dev/pytest/issues/2504#issuecomment-309475790
-        self.assertIn(expected_output, output, f"{name}: {output}")
+        self.assertEqual([('file.txt', line) for line in expected_lines],
+                         [(event.path, event.position + 1) for event in events.events], name)
+        # placements only go to the event sink
+        self.assertNotIn("Applied change", self.capfd.readouterr().out)
 
         # Assert that the modified file in the target repo has the expected content
         modified_file_target_path = os.path.join(self.target_repo.working_tree_dir, 'file.txt')
@@ -152,6 +220,224 @@ class TestCustomApply(unittest.TestCase):
         self.assertEqual(expected_target_content, target_content,
                          f"{name}: Modified file content should match")
 
+    def test_parallel_apply_matches_sequential(self):
+        file_names = ['file.txt', 'other.txt', 'missing.txt', 'created.txt']
+        # targets differ from the source away from the change, so the hunks are searched
+        target_content = self.initial_content.replace("Line 90\n", "Line ninety\n")
+        create_and_commit_file(self.target_repo, 'file.txt', target_content, "Diverge")
+        for name in file_names[1:3]:
+            create_and_commit_file(self.source_repo, name, self.initial_content, "Add file")
+            create_and_commit_file(self.target_repo, name, target_content, "Add file")
+        os.remove(os.path.join(self.target_repo.working_tree_dir, 'missing.txt'))
+        for name in file_names:
+            with open(os.path.join(self.source_repo.working_tree_dir, name), 'w') as f:
+                f.write(self.initial_content.replace("Line 20\n", f"Line 20 of {name}\n"))
+        self.source_repo.index.add(file_names)
+        self.source_repo.index.commit("Modify files")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+        outputs = []
+        for workers in (0, 2):
+            events = RecordingEventSink()
+            custom_apply = CustomApply(self.target_repo, dry_run=True, workers=workers, events=events)
+            result = custom_apply.apply(diff)
+            custom_apply.close()
+            outputs.append((result, self.capfd.readouterr().out, events.events))
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn((APPLIED, 'other.txt', 19),
+                      [(event.kind, event.path, event.position) for event in outputs[1][2]])
+
+    def test_patch_in_spawned_worker(self):
+        # a spawned worker starts from a fresh interpreter, everything it needs is imported or passed to it
+        modified_content = self.initial_content.replace("Line 20\n", "Line twenty\n")
+        create_and_commit_file(self.source_repo, 'file.txt', modified_content, "Modify file")
+        commit = self.source_repo.commit('HEAD')
+        patch = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)[0].diff
+        lines = self.initial_content.encode().split(b"\n")
+
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            future = executor.submit(_patch_in_worker, False, 100, 0, {APPLIED}, 'file.txt', patch, lines,
+                                     tuple(iter_diff_hunks(patch)))
+            placed, placements, events = future.result()
+
+        self.assertTrue(placed)
+        self.assertEqual(1, len(placements))
+        self.assertEqual([(APPLIED, 'file.txt', 19)], [(event.kind, event.path, event.position) for event in events])
+
+    def test_handle_modify_prefers_header_position(self):
+        # The same block repeats through the file, so only the hunk header tells which copy was changed
+        content = "".join([f"Line {idx % 10}\n" for idx in range(100)])
+        modified_content = content.replace("Line 5\n", "Modified Line 5\n").replace("Modified Line 5\n", "Line 5\n", 5)
+        create_and_commit_file(self.source_repo, 'file.txt', content, "Repeated content")
+        create_and_commit_file(self.source_repo, 'file.txt', modified_content[:-1], "Modify file")
+        create_and_commit_file(self.target_repo, 'file.txt', content[:-1], "Repeated content")
+
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+        CustomApply(self.target_repo).apply(diff)
+
+        modified_file_target_path = os.path.join(self.target_repo.working_tree_dir, 'file.txt')
+        with open(modified_file_target_path, 'r') as f:
+            # the target had no line ending at the end of the file, neither has the patched one
+            self.assertEqual(modified_content[:-1], f.read())
+
+    def test_handle_modify_takes_new_version_of_pre_image(self):
+        create_and_commit_file(self.source_repo, 'file.txt', "com.pipeline\r\nLine\r\n" * 50, "CRLF file")
+        create_and_commit_file(self.source_repo, 'file.txt', "com.pipeline\r\nLine\r\n" * 49 + "Last", "Modify")
+        create_and_commit_file(self.target_repo, 'file.txt', "com.insly\r\nLine\r\n" * 50, "CRLF file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+        rewriter = ReplacementRewriter([(b"com.pipeline", b"com.insly")])
+        self.assertTrue(CustomApply(self.target_repo, replacement_fn=rewriter).apply(diff))
+
+        self.assertIn("Target file matches the original version", self.capfd.readouterr().out)
+        with open(os.path.join(self.target_repo.working_tree_dir, 'file.txt'), 'rb') as f:
+            self.assertEqual(b"com.insly\r\nLine\r\n" * 49 + b"Last", f.read())
+
+    def test_handle_modify_reads_target_once(self):
+        modified_content = self.initial_content.replace("Line 20\n", "Line twenty\n")
+        create_and_commit_file(self.source_repo, 'file.txt', modified_content, "Modify file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+        target_path = os.path.join(self.target_repo.working_tree_dir, 'file.txt')
+        rewriter = ReplacementRewriter([(b"Line 9\n", b"Line nine\n")])
+
+        # the pre-image check, the placement key and the search share one read of a diverged file
+        create_and_commit_file(self.target_repo, 'file.txt', self.initial_content.replace("Line 50\n", ""), "Diverge")
+        with mock.patch.object(WorktreeStore, 'read', autospec=True, side_effect=WorktreeStore.read) as read:
+            self.assertTrue(CustomApply(self.target_repo, replacement_fn=rewriter).apply(diff))
+        self.assertEqual(1, read.call_count)
+
+        # a clean file with the SHA of the original version isn't read at all, a rewriter without rules, like the
+        # one of a target without replacements, doesn't count as replacements
+        for replacement_fn in (None, ReplacementRewriter([])):
+            with open(target_path, 'w') as f:
+                f.write(self.initial_content)
+            # older than the index, so its index entry is trusted
+            os.utime(target_path, ns=(0, os.stat(target_path).st_mtime_ns - 10 ** 9))
+            self.target_repo.git.add('file.txt')
+            with mock.patch.object(WorktreeStore, 'read', autospec=True, side_effect=WorktreeStore.read) as read:
+                self.assertTrue(CustomApply(self.target_repo, replacement_fn=replacement_fn).apply(diff))
+            read.assert_not_called()
+            self.assertIn("Target file matches the original version", self.capfd.readouterr().out)
+            with open(target_path, 'r') as f:
+                self.assertEqual(modified_content, f.read())
+
+    def test_handle_modify_reuses_placements(self):
+        modified_content = self.initial_content.replace("Line 20\n", "Line twenty\n").replace("Line 80\n", "")
+        create_and_commit_file(self.source_repo, 'file.txt', modified_content, "Modify file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+        placements = PlacementCache(self.source_repo)
+        create_and_commit_file(self.target_repo, 'file.txt', self.initial_content.replace("Line 50\n", ""), "Diverge")
+
+        runs = []
+        for _ in range(2):
+            self.target_repo.git.checkout('--', 'file.txt')
+            events = RecordingEventSink()
+            self.assertTrue(CustomApply(self.target_repo, placements=placements, events=events).apply(diff))
+            with open(os.path.join(self.target_repo.working_tree_dir, 'file.txt'), 'r') as f:
+                self.assertEqual(modified_content.replace("Line 50\n", "").splitlines(), f.read().splitlines())
+            runs.append([(event.kind, event.position) for event in events.events])
+
+        self.assertEqual([(MATCH, 19), (APPLIED, 19), (MATCH, 78), (APPLIED, 78)], runs[0])
+        # the placements are reused without a search
+        self.assertEqual([(APPLIED, 19), (APPLIED, 78)], runs[1])
+        # a placement is found again once the file changed
+        create_and_commit_file(self.target_repo, 'file.txt', "Line 0\n" + self.initial_content, "Prepend a line")
+        events = RecordingEventSink([MATCH])
+        CustomApply(self.target_repo, placements=placements, events=events).apply(diff)
+        self.assertEqual([MATCH, MATCH], [event.kind for event in events.events])
+
+    def test_handle_modify_mapped_file(self):
+        modified_content = self.initial_content.replace("Line 20\n", "Line twenty\n")
+        create_and_commit_file(self.source_repo, 'file.txt', modified_content, "Modify file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+        target_content = self.initial_content.replace("Line 50\n", "").replace("\n", "\r\n").encode()
+        target_path = os.path.join(self.target_repo.working_tree_dir, 'file.txt')
+
+        for workers in (0, 2):
+            with open(target_path, 'wb') as f:
+                f.write(target_content)
+            os.chmod(target_path, 0o755)
+            with mock.patch('target_store.MAP_SIZE', 0):
+                custom_apply = CustomApply(self.target_repo, workers=workers)
+                self.assertTrue(custom_apply.apply(diff))
+                custom_apply.close()
+
+            # the file is replaced with its line endings, the missing one at the end and its mode kept
+            with open(target_path, 'rb') as f:
+                self.assertEqual(target_content.replace(b"Line 20\r\n", b"Line twenty\r\n"), f.read())
+            self.assertEqual(0o755, stat.S_IMODE(os.stat(target_path).st_mode))
+
+    def test_search_events(self):
+        modified_content = self.initial_content.replace("Line 20\n", "Line twenty\n").replace("Line 80\n", "")
+        create_and_commit_file(self.source_repo, 'file.txt', modified_content, "Modify file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+        target_content = self.initial_content.replace("Line 20\n", "Line 20 changed\n")
+        target_content = "".join(line for line in target_content.splitlines(True) if not line.startswith("Line 7"))
+        create_and_commit_file(self.target_repo, 'file.txt', target_content, "Diverge")
+
+        for workers in (0, 2):
+            events = RecordingEventSink()
+            custom_apply = CustomApply(self.target_repo, dry_run=True, events=events, workers=workers)
+            self.assertFalse(custom_apply.apply([diff[0], diff[0]]))
+            custom_apply.close()
+
+            near_miss, unplaced = events.events[:2]
+            self.assertEqual((NEAR_MISS, 'file.txt', 0, 18, (b"Line 20 changed",)),
+                             (near_miss.kind, near_miss.path, near_miss.hunk_id, near_miss.position,
+                              near_miss.found_lines))
+            self.assertEqual((UNPLACED, 1, -1), (unplaced.kind, unplaced.hunk_id, unplaced.position))
+            self.assertEqual(events.events[:2], events.events[2:])
+
+        events = NullEventSink()
+        CustomApply(self.target_repo, dry_run=True, events=events).apply(diff)
+        self.assertNotIn("Line 20 changed", "".join(self.capfd.readouterr()))
+
+    def test_fuzzy_match(self):
+        modified_content = self.initial_content.replace("Line 20\n", "Line twenty\n")
+        create_and_commit_file(self.source_repo, 'file.txt', modified_content, "Modify file")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+        # the target indents the changed line differently and changed a context line
+        target_content = self.initial_content.replace("Line 20\n", "  Line 20\n").replace("Line 18\n", "Line 18!\n")
+        create_and_commit_file(self.target_repo, 'file.txt', target_content, "Diverge")
+
+        self.assertFalse(CustomApply(self.target_repo).apply(diff))
+        for workers in (0, 2):
+            self.target_repo.git.checkout('--', 'file.txt')
+            events = RecordingEventSink([FUZZY_MATCH])
+            custom_apply = CustomApply(self.target_repo, events=events, workers=workers, fuzz=0.2)
+            self.assertTrue(custom_apply.apply([diff[0]]))
+            custom_apply.close()
+
+            self.assertEqual([(FUZZY_MATCH, 19, (b"  Line 20",), 1)],
+                             [(event.kind, event.position, event.found_lines, event.distance)
+                              for event in events.events])
+            with open(os.path.join(self.target_repo.working_tree_dir, 'file.txt'), 'r') as f:
+                self.assertEqual(target_content.replace("  Line 20\n", "Line twenty\n"), f.read())
+
+    def test_hunk_without_context(self):
+        create_and_commit_file(self.source_repo, 'VERSION', "1.2.3\n", "Add version")
+        create_and_commit_file(self.source_repo, 'VERSION', "1.2.4\n", "Bump version")
+        create_and_commit_file(self.target_repo, 'VERSION', "1.2.3-target\n", "Add version")
+        commit = self.source_repo.commit('HEAD')
+        diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+        for fuzz in (0, 0.2):
+            events = RecordingEventSink()
+            self.assertFalse(CustomApply(self.target_repo, events=events, fuzz=fuzz).apply(diff))
+            self.assertEqual([(UNPLACED, 'VERSION')], [(event.kind, event.path) for event in events.events])
+            with open(os.path.join(self.target_repo.working_tree_dir, 'VERSION'), 'r') as f:
+                self.assertEqual("1.2.3-target\n", f.read())
+
     # def test_handle_delete(self):
     #     # Delete an existing file in the source repo and commit it
     #     # ...
@@ -170,3 +456,27 @@ class TestCustomApply(unittest.TestCase):
         # Remove the temporary directories created in setUp
         shutil.rmtree(self.source_repo.working_tree_dir)
         shutil.rmtree(self.target_repo.working_tree_dir)
+
+
+class TestIterDiffHunks(unittest.TestCase):
+    def test_header_without_line_counts(self):
+        patch = b"@@ -1 +1 @@\n-a\n+b\n\\ No newline at end of file\n@@ -7,2 +7,3 @@\n c\r\n+d\r\n e\r\n"
+
+        hunks = list(iter_diff_hunks(patch))
+
+        self.assertEqual(2, len(hunks))
+        self.assertEqual((1, 1, 1, 1), (hunks[0].a_start, hunks[0].a_lines, hunks[0].b_start, hunks[0].b_lines))
+        self.assertEqual(((b"a",), (b"b",)), (hunks[0].removed_lines, hunks[0].added_lines))
+        self.assertEqual((7, 2, 7, 3), (hunks[1].a_start, hunks[1].a_lines, hunks[1].b_start, hunks[1].b_lines))
+        self.assertEqual(((b"c",), (b"d",), (b"e",)),
+                         (hunks[1].before_context, hunks[1].added_lines, hunks[1].after_context))
+
+    def test_broken_context_starts_new_hunk(self):
+        patch = b"@@ -10,5 +10,5 @@\n a\n-b\n+B\n c\n-d\n+D\n e\n"
+
+        hunks = list(iter_diff_hunks(patch))
+
+        self.assertEqual([(10, 10), (12, 12)], [(hunk.a_start, hunk.b_start) for hunk in hunks])
+        self.assertEqual((b"c",), hunks[1].before_context)
+        self.assertEqual(((b"d",), (b"D",)), (hunks[1].removed_lines, hunks[1].added_lines))
+        self.assertEqual((b"e",), hunks[1].after_context)
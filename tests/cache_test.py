@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from git import Repo
+
+from apply import CustomApply
+from cache import PatchCache, PlacementCache, patch_cache_key
+from tests.apply_test import create_and_commit_file
+
+
+class TestPatchCache(unittest.TestCase):
+    def setUp(self):
+        self.repo = Repo.init(tempfile.mkdtemp())
+        create_and_commit_file(self.repo, 'file.txt', "".join([f"Line {idx}\n" for idx in range(1, 30)]),
+                               "Initial commit")
+        create_and_commit_file(self.repo, 'file.txt', "".join([f"Line {idx}\n" for idx in range(1, 30) if idx != 10]),
+                               "Remove a line")
+        create_and_commit_file(self.repo, 'added.txt', "added\n", "Add a file")
+        self.cache_dir = tempfile.mkdtemp()
+
+    def diff(self, rev):
+        commit = self.repo.commit(rev)
+        return commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+    def test_round_trip(self):
+        cache = PatchCache(self.repo, path=self.cache_dir)
+        for rev in ('HEAD~1', 'HEAD'):
+            diff_index = self.diff(rev)
+            hunks = CustomApply(None).parse_hunks(diff_index)
+            key = patch_cache_key(self.repo.commit(rev).hexsha, [(b"Line", b"Row")], 5)
+            self.assertNotIn(key, cache)
+            cache.put(key, diff_index, hunks)
+
+            cached_index, cached_hunks = cache.get(key, self.repo)
+            self.assertEqual(hunks, cached_hunks)
+            for diff, cached in zip(diff_index, cached_index):
+                self.assertEqual((diff.a_path, diff.b_path, diff.new_file, diff.diff, diff.b_mode),
+                                 (cached.a_path, cached.b_path, cached.new_file, cached.diff, cached.b_mode))
+                self.assertEqual(diff.b_blob.data_stream.read(), cached.b_blob.data_stream.read())
+
+    def test_keys_depend_on_rules(self):
+        self.assertNotEqual(patch_cache_key("a" * 40, [(b"a", b"b")], 5), patch_cache_key("a" * 40, [(b"a", b"c")], 5))
+        self.assertNotEqual(patch_cache_key("a" * 40, [], 5), patch_cache_key("a" * 40, [], 3))
+
+    def test_least_recently_used_are_evicted(self):
+        diff_index = self.diff('HEAD~1')
+        size = len(open(self.put(PatchCache(self.repo, path=self.cache_dir), "first", diff_index), 'rb').read())
+        cache = PatchCache(self.repo, max_size=size * 2, path=self.cache_dir)
+        self.put(cache, "second", diff_index)
+        # reading the first entry makes the second one the least recently used
+        self.assertIsNotNone(cache.get("first", self.repo))
+        self.put(cache, "third", diff_index)
+
+        self.assertIn("first", cache)
+        self.assertNotIn("second", cache)
+        self.assertIn("third", cache)
+
+    def test_corrupted_entry_is_a_miss(self):
+        cache = PatchCache(self.repo, path=self.cache_dir)
+        with open(self.put(cache, "key", self.diff('HEAD')), 'wb') as f:
+            f.write(b"garbage")
+
+        self.assertIsNone(cache.get("key", self.repo))
+        self.assertNotIn("key", cache)
+
+    @staticmethod
+    def put(cache, key, diff_index):
+        cache.put(key, diff_index, CustomApply(None).parse_hunks(diff_index))
+        return cache._entry_path(key)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo.working_tree_dir)
+        shutil.rmtree(self.cache_dir)
+
+
+class TestPlacementCache(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "placements")
+
+    def test_persisted_and_compacted(self):
+        cache = PlacementCache(None, path=self.path)
+        for idx in range(3):
+            cache.put(f"key{idx}", [(idx, 1), (idx + 10, 0)])
+        cache.put("key0", [(5, 2)])
+
+        cache = PlacementCache(None, max_entries=2, path=self.path)
+        self.assertEqual([(5, 2)], cache.get("key0"))
+        self.assertIsNone(cache.get("key1"))
+        self.assertEqual([(2, 1), (12, 0)], cache.get("key2"))
+        with open(self.path) as f:
+            self.assertEqual(2, len(f.readlines()))
+
+    def test_truncated_line_is_skipped(self):
+        with open(self.path, 'w') as f:
+            f.write("key0 1:2\nkey1 3:4 5")
+
+        cache = PlacementCache(None, path=self.path)
+        self.assertEqual([(1, 2)], cache.get("key0"))
+        self.assertIsNone(cache.get("key1"))
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
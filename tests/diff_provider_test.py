@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from git import Repo
+from gitdb.exc import BadName
+
+from diff_provider import BatchDiffProvider
+from tests.apply_test import create_and_commit_file
+
+
+def diff_fields(diff_index):
+    return [(diff.a_path, diff.b_path, diff.new_file, diff.deleted_file, diff.renamed_file, diff.diff)
+            for diff in diff_index]
+
+
+class TestBatchDiffProvider(unittest.TestCase):
+    def setUp(self):
+        self.repo = Repo.init(tempfile.mkdtemp())
+        create_and_commit_file(self.repo, 'file.txt', "".join([f"Line {idx}\n" for idx in range(1, 100)]),
+                               "Initial commit")
+        create_and_commit_file(self.repo, 'file.txt', "".join([f"Line {idx}\n" for idx in range(1, 50)]),
+                               "Modify file")
+        create_and_commit_file(self.repo, 'crlf.txt', "first\r\nsecond\r\n", "Add file")
+        self.repo.index.commit("Empty commit")
+        os.makedirs(os.path.join(self.repo.working_tree_dir, 'nested'))
+        self.repo.index.move(['file.txt', 'nested/file.txt'])
+        self.repo.index.commit("Move file")
+
+    def test_matches_commit_diff(self):
+        commits = list(reversed(list(self.repo.iter_commits())))[1:]
+
+        with BatchDiffProvider(self.repo, unified=5) as provider:
+            for commit, diff_index in provider.iter_diffs(commits):
+                expected = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True, unified=5)
+                self.assertEqual(diff_fields(expected), diff_fields(diff_index), commit.message)
+
+    def test_blobs_are_readable(self):
+        commit = self.repo.commit('HEAD~2')
+
+        with BatchDiffProvider(self.repo) as provider:
+            diff_index = provider.diff(commit)
+
+        self.assertEqual([b"first\r\nsecond\r\n"], [diff.b_blob.data_stream.read() for diff in diff_index])
+
+    def test_prefetch_matches_diff(self):
+        commits = [commit.hexsha for commit in reversed(list(self.repo.iter_commits()))]
+
+        with BatchDiffProvider(self.repo, unified=5) as provider:
+            expected = [(sha, diff_fields(provider.diff(self.repo.commit(sha)))) for sha in commits]
+            for depth in (0, 2):
+                prefetched = list(provider.prefetch(commits, depth=depth))
+
+                self.assertEqual(expected, [(sha, diff_fields(diff_index)) for sha, diff_index in prefetched])
+                self.assertTrue(all(diff.b_blob.repo is self.repo
+                                    for _, diff_index in prefetched for diff in diff_index if diff.b_blob))
+
+            with self.assertRaises(BadName):
+                list(provider.prefetch(commits + ["0" * 39], depth=2))
+
+    def test_exclude_prefixes(self):
+        commits = list(reversed(list(self.repo.iter_commits())))[1:]
+
+        with BatchDiffProvider(self.repo, exclude_prefixes=['crl', 'nested/']) as provider:
+            paths = [[diff.b_path or diff.a_path for diff in diff_index]
+                     for _, diff_index in provider.iter_diffs(commits)]
+
+        # the move shows up as a deletion only, its new path is excluded
+        self.assertEqual([['file.txt'], [], [], ['file.txt']], paths)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo.working_tree_dir)
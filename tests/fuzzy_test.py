@@ -0,0 +1,54 @@
+import unittest
+
+from apply import DiffHunk
+from fuzzy import FuzzyMatch, FuzzyMatcher, _align, normalize
+from line_index import LineIndex
+
+
+def hunk(removed=(b"Line 50",), added=(b"Line fifty",)):
+    return DiffHunk(48, 7, 48, 7, (b"Line 47", b"Line 48", b"Line 49"), (b"Line 51", b"Line 52", b"Line 53"),
+                    removed, added)
+
+
+class TestFuzzyMatcher(unittest.TestCase):
+    def setUp(self):
+        self.lines = [f"Line {idx}".encode() for idx in range(100)]
+
+    def test_normalize(self):
+        self.assertEqual(b"if(a){", normalize(b"\tif (a)  {\r"))
+
+    def test_align_pairs_equal_lines(self):
+        # the extra line is skipped rather than taken for the first line of the pattern
+        self.assertEqual((1, [1, 2, 4], [1, 3, 4]), _align([b"a", b"b"], [b"x", b"a", b"c", b"b"], 1))
+        self.assertIsNone(_align([b"a", b"b"], [b"c", b"d"], 1))
+
+    def test_whitespace_and_extra_lines(self):
+        self.lines[50] = b"  Line   50"
+        self.lines.insert(52, b"Extra")
+        self.lines[48] = b"Line forty eight"
+
+        match = FuzzyMatcher(LineIndex(self.lines), 0.3).find(hunk(), 50)
+
+        self.assertEqual(FuzzyMatch(50, 1, 2, False), match)
+        self.assertIsNone(FuzzyMatcher(LineIndex(self.lines), 0.1).find(hunk(), 50))
+
+    def test_far_from_expected_position(self):
+        self.lines[20:20] = [b"Moved"] * 30
+        self.lines[80] = b"Line 50 changed in the target"
+
+        self.assertEqual(FuzzyMatch(80, 1, 1, False), FuzzyMatcher(LineIndex(self.lines), 0.2).find(hunk(), 50))
+
+    def test_already_applied(self):
+        self.lines[50] = b"Line fifty"
+        self.lines[48] = b"Line forty eight"
+
+        self.assertEqual(FuzzyMatch(50, 1, 1, True), FuzzyMatcher(LineIndex(self.lines), 0.3).find(hunk(), 50))
+
+    def test_follows_splices(self):
+        file_index = LineIndex(self.lines)
+        matcher = FuzzyMatcher(file_index, 0.2)
+        self.assertEqual(FuzzyMatch(50, 1, 0, False), matcher.find(hunk(), 50))
+        file_index.splice(10, 0, [b"New"] * 5)
+        matcher.splice(10, 0, [b"New"] * 5)
+
+        self.assertEqual(FuzzyMatch(55, 1, 0, False), matcher.find(hunk(), 50))
@@ -0,0 +1,87 @@
+import mmap
+import pickle
+import random
+import tempfile
+import unittest
+
+from line_index import FileContent, FileLines, LineIndex
+
+
+class TestLineIndex(unittest.TestCase):
+    def test_positions(self):
+        index = LineIndex(["a", "b", "a", "c"])
+        self.assertEqual([0, 2], list(index.positions("a")))
+        self.assertEqual([], list(index.positions("d")))
+
+    def test_splice_shifts_positions(self):
+        index = LineIndex(["a", "b", "a", "c"])
+        index.splice(1, 1, ["x", "a", "y"])
+
+        self.assertEqual(["a", "x", "a", "y", "a", "c"], list(index))
+        self.assertEqual([0, 2, 4], list(index.positions("a")))
+        self.assertEqual([5], list(index.positions("c")))
+        self.assertEqual([], list(index.positions("b")))
+        self.assertEqual(("x", "a", "y"), index[1:4])
+
+    def test_splice_matches_list(self):
+        rnd = random.Random(42)
+        for _ in range(300):
+            lines = [rnd.choice("abcd") for _ in range(rnd.randint(0, 30))]
+            index = LineIndex(list(lines))
+            for _ in range(rnd.randint(1, 8)):
+                start = rnd.randint(0, len(lines))
+                length = rnd.randint(0, min(4, len(lines) - start))
+                new_lines = [rnd.choice("abcdx") for _ in range(rnd.randint(0, 4))]
+                lines[start:start + length] = new_lines
+                index.splice(start, length, new_lines)
+
+                self.assertEqual(lines, list(index))
+                self.assertEqual(len(lines), len(index))
+                for line in "abcdx":
+                    self.assertEqual([idx for idx, value in enumerate(lines) if value == line],
+                                     list(index.positions(line)))
+                low = rnd.randint(0, len(lines))
+                high = rnd.randint(low, len(lines))
+                self.assertEqual(tuple(lines[low:high]), index[low:high])
+
+
+class TestFileContent(unittest.TestCase):
+    def test_unchanged_file_is_rendered_as_is(self):
+        for data in (b"", b"a\n", b"a\r\nb\r\n", b"a\nb", b"a\r\nb\nc\r\n", b"\n\n"):
+            content = FileContent(data)
+            self.assertEqual(data, content.render(LineIndex(content.lines)))
+
+    def test_line_endings_are_kept(self):
+        content = FileContent(b"a\r\nb\nc\r\nd\r\n")
+        self.assertEqual([b"a", b"b", b"c", b"d"], content.lines)
+        index = LineIndex(content.lines)
+        index.splice(2, 1, [b"x", b"y"])
+
+        self.assertEqual(b"a\r\nb\nx\r\ny\r\nd\r\n", content.render(index))
+
+    def test_missing_final_newline_is_kept(self):
+        content = FileContent(b"a\nb")
+        index = LineIndex(content.lines)
+        index.splice(2, 0, [b"c"])
+        self.assertEqual(b"a\nb\nc", content.render(index))
+
+        index = LineIndex(content.lines)
+        index.splice(1, 1, [])
+        self.assertEqual(b"a", content.render(index))
+
+    def test_mapped_file_matches_bytes(self):
+        for data in (b"a\r\nb\nc\r\n", b"a\nb", b"\n\nc"):
+            with tempfile.TemporaryFile() as f:
+                f.write(data)
+                f.flush()
+                with FileContent(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mapped:
+                    content = FileContent(data)
+                    self.assertIsInstance(mapped.lines, FileLines)
+                    self.assertEqual(content.lines, list(mapped.lines))
+                    self.assertEqual(tuple(content.lines[1:]), mapped.lines[1:])
+                    self.assertEqual(content.lines, pickle.loads(pickle.dumps(mapped.lines)))
+
+                    for lines in (content.lines, mapped.lines):
+                        index = LineIndex(lines)
+                        index.splice(1, 1, [b"x"])
+                        self.assertEqual(content.render(index), mapped.render(index))
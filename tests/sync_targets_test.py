@@ -0,0 +1,119 @@
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from git import Repo
+from parameterized import parameterized
+
+from cache import PatchCache
+from diff_provider import BatchDiffProvider
+from hunk_events import LoggingEventSink, NullEventSink
+from sync_targets import UNIFIED, SyncSource, SyncTarget, load_prepared, prepare_diff, store_prepared, sync_order
+from tests.apply_test import create_and_commit_file
+
+REPLACEMENTS = [{"from": "src/com/pipeline", "to": "src/com/skybonds"}, {"from": "com.pipeline", "to": "com.skybonds"}]
+
+
+def write_file(repo, path, content):
+    os.makedirs(os.path.dirname(os.path.join(repo.working_tree_dir, path)), exist_ok=True)
+    create_and_commit_file(repo, path, content, f"Write {path}")
+
+
+class TestSyncTargets(unittest.TestCase):
+    def setUp(self):
+        self.source_repo = Repo.init(tempfile.mkdtemp())
+        content = "".join(f"package com.pipeline line {idx}\n" for idx in range(20))
+        write_file(self.source_repo, 'src/com/pipeline/A.groovy', content)
+        self.base = self.source_repo.head.commit.hexsha
+        write_file(self.source_repo, 'src/com/pipeline/B.groovy', "new com.pipeline file\n")
+        write_file(self.source_repo, 'src/com/pipeline/A.groovy', content.replace("line 5\n", "line five\n"))
+
+        self.target_repos = {}
+        self.configs = {}
+        for name, replacements in (('renamed', REPLACEMENTS), ('same', [])):
+            repo = Repo.init(tempfile.mkdtemp())
+            with repo.config_writer() as config:
+                config.set_value('user', 'name', "Syncer")
+                config.set_value('user', 'email', "syncer@example.com")
+            if replacements:
+                write_file(repo, 'src/com/skybonds/A.groovy', content.replace("pipeline", "skybonds"))
+            else:
+                write_file(repo, 'src/com/pipeline/A.groovy', content)
+            self.target_repos[name] = repo
+            self.configs[name] = {"path": repo.working_tree_dir, "replacements": replacements}
+        self.cache_dir = tempfile.mkdtemp()
+
+    def source(self, interactive, patch_cache=None):
+        options = argparse.Namespace(range=f"{self.base}..HEAD", interactive=interactive, headless=False, workers=0,
+                                     fuzz=0)
+        return SyncSource(self.source_repo, {"path": self.source_repo.working_tree_dir, "replacements": []},
+                          len(self.configs), options, logging.getLogger(__name__), 'v', 'pipe/sync', patch_cache)
+
+    def open_targets(self, source):
+        targets = [SyncTarget(source, name, config) for name, config in self.configs.items()]
+        for target in targets:
+            self.assertTrue(target.select_commits())
+            target.open()
+        return targets
+
+    @parameterized.expand([("interactive", True), ("concurrent", False)])
+    def test_targets_prepare_their_own_copy(self, _, interactive):
+        # without source replacements and sequential targets the shared patches used to be rewritten in place
+        source = self.source(interactive)
+        targets = self.open_targets(source)
+        with BatchDiffProvider(source.repo, unified=UNIFIED) as diff_provider:
+            for commit_hash in sync_order(source, targets):
+                prepared = prepare_diff(source, targets, diff_provider.diff(source.repo.commit(commit_hash)))
+                for target in targets:
+                    target.apply(commit_hash, prepared[target.name], f"Sync {commit_hash}")
+        for target in targets:
+            target.close()
+
+        for name, prefix in (('renamed', 'src/com/skybonds'), ('same', 'src/com/pipeline')):
+            tree = self.target_repos[name].head.commit.tree
+            self.assertEqual(["A.groovy", "B.groovy"], sorted(blob.name for blob in tree[prefix].blobs))
+            self.assertIn(b"line five", tree[f"{prefix}/A.groovy"].data_stream.read())
+            self.assertEqual(f"new {prefix[4:].replace('/', '.')} file\n".encode(),
+                             tree[f"{prefix}/B.groovy"].data_stream.read())
+            self.assertEqual(3, len(list(self.target_repos[name].iter_commits())))
+
+    def test_events_are_dropped_below_log_level(self):
+        source = self.source(False)
+        targets = self.open_targets(source)
+        self.assertTrue(all(isinstance(target.custom_apply.events, LoggingEventSink) for target in targets))
+        for target in targets:
+            target.close()
+
+        source.logger = logging.getLogger(f"{__name__}.quiet")
+        source.logger.setLevel(logging.ERROR)
+        targets = self.open_targets(source)
+        self.assertTrue(all(isinstance(target.custom_apply.events, NullEventSink) for target in targets))
+        for target in targets:
+            target.close()
+
+    def test_prepared_patches_are_cached(self):
+        source = self.source(False, PatchCache(self.source_repo, path=self.cache_dir))
+        targets = self.open_targets(source)
+        commit_hash = self.source_repo.head.commit.hexsha
+        self.assertIsNone(load_prepared(source, commit_hash, targets))
+
+        with BatchDiffProvider(source.repo, unified=UNIFIED) as diff_provider:
+            prepared = prepare_diff(source, targets, diff_provider.diff(source.repo.commit(commit_hash)))
+        store_prepared(source, commit_hash, prepared, targets)
+        cached = load_prepared(source, commit_hash, targets)
+
+        for target in targets:
+            self.assertEqual(prepared[target.name][1], cached[target.name][1])
+            self.assertEqual([diff.b_path for diff in prepared[target.name][0]],
+                             [diff.b_path for diff in cached[target.name][0]])
+        self.assertEqual(['src/com/skybonds/A.groovy'], [diff.b_path for diff in cached['renamed'][0]])
+        for target in targets:
+            target.close()
+
+    def tearDown(self):
+        for repo in [self.source_repo, *self.target_repos.values()]:
+            shutil.rmtree(repo.working_tree_dir)
+        shutil.rmtree(self.cache_dir)
@@ -0,0 +1,128 @@
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from git import Repo
+
+from apply import CustomApply
+from target_store import ObjectStore, WorktreeStore
+from tests.apply_test import create_and_commit_file
+
+
+class TestObjectStore(unittest.TestCase):
+    def setUp(self):
+        self.source_repo = Repo.init(tempfile.mkdtemp())
+        self.target_repo = Repo.init(tempfile.mkdtemp())
+        with self.target_repo.config_writer() as config:
+            config.set_value('user', 'name', "Syncer")
+            config.set_value('user', 'email', "syncer@example.com")
+        for repo in (self.source_repo, self.target_repo):
+            os.makedirs(os.path.join(repo.working_tree_dir, 'dir', 'nested'))
+            create_and_commit_file(repo, 'file.txt', "".join([f"Line {idx}\n" for idx in range(1, 30)]),
+                                   "Initial commit")
+            create_and_commit_file(repo, 'dir/nested/deleted.txt', "deleted\n", "Add file")
+            create_and_commit_file(repo, 'dir/moved.txt', "moved\n", "Add file")
+
+        with open(os.path.join(self.source_repo.working_tree_dir, 'file.txt'), 'w') as f:
+            f.write("".join([f"Line {idx}\n" for idx in range(1, 30) if idx != 10]))
+        with open(os.path.join(self.source_repo.working_tree_dir, 'dir', 'added.txt'), 'w') as f:
+            f.write("added\n")
+        os.makedirs(os.path.join(self.source_repo.working_tree_dir, 'other'))
+        self.source_repo.index.add(['file.txt', 'dir/added.txt'])
+        self.source_repo.index.remove(['dir/nested/deleted.txt'], working_tree=True)
+        self.source_repo.index.move(['dir/moved.txt', 'other/moved.txt'])
+        self.source_repo.index.commit("Change everything")
+
+        commit = self.source_repo.commit('HEAD')
+        self.diff = commit.parents[0].diff(commit, create_patch=True, ignore_cr_at_eol=True)
+
+    def test_commit_matches_worktree(self):
+        base = self.target_repo.head.commit
+        store = ObjectStore(self.target_repo, base)
+        CustomApply(self.target_repo, store=store).apply(self.diff)
+        headless_commit = store.commit("Change everything\n\nOriginal commit: 1")
+
+        # the working tree is untouched by the object store
+        self.assertFalse(self.target_repo.is_dirty(untracked_files=True))
+        self.assertEqual([base], headless_commit.parents)
+        self.assertEqual("Change everything\n\nOriginal commit: 1\n", headless_commit.message)
+
+        os.makedirs(os.path.join(self.target_repo.working_tree_dir, 'other'))
+        result = CustomApply(self.target_repo).apply(self.diff)
+        WorktreeStore(self.target_repo).commit("Change everything", result.touched_paths)
+
+        self.assertEqual(self.source_repo.head.commit.tree.hexsha, headless_commit.tree.hexsha)
+        self.assertEqual(self.target_repo.head.commit.tree.hexsha, headless_commit.tree.hexsha)
+        self.assertEqual(WorktreeStore(self.target_repo).blob_sha('file.txt'), store.blob_sha('file.txt'))
+
+    def test_reset_and_empty_commit(self):
+        store = ObjectStore(self.target_repo, self.target_repo.head.commit)
+        CustomApply(self.target_repo, store=store).apply(self.diff)
+        store.reset()
+
+        self.assertIsNone(store.commit("Nothing"))
+        self.assertEqual(self.target_repo.head.commit, store.head)
+        self.assertTrue(store.exists('dir/nested/deleted.txt'))
+
+    def tearDown(self):
+        shutil.rmtree(self.source_repo.working_tree_dir)
+        shutil.rmtree(self.target_repo.working_tree_dir)
+
+
+class TestWorktreeStore(unittest.TestCase):
+    def setUp(self):
+        self.repo = Repo.init(tempfile.mkdtemp())
+        self.store = WorktreeStore(self.repo)
+        create_and_commit_file(self.repo, 'file.txt', "old\n", "Initial commit")
+
+    def test_large_file_is_mapped(self):
+        self.assertEqual(b"old\n", self.store.read('file.txt'))
+        with mock.patch('target_store.MAP_SIZE', 0):
+            data = self.store.read('file.txt')
+        self.assertIsInstance(data, mmap.mmap)
+        # the mapped content is still readable once the file is replaced
+        with self.store.open('file.txt', 'wb') as f:
+            f.write(b"new\n")
+        self.assertEqual(b"old\n", data[:])
+        data.close()
+        self.assertEqual(b"new\n", self.store.read('file.txt'))
+
+    def test_known_blob_sha(self):
+        path = os.path.join(self.repo.working_tree_dir, 'file.txt')
+        # a file older than the index is clean while its size and modification time are the ones indexed
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns - 10 ** 9))
+        # staged with git, which indexes the stat data of the file
+        self.repo.git.add('file.txt')
+        self.assertEqual(self.repo.head.commit.tree['file.txt'].hexsha, self.store.known_blob_sha('file.txt'))
+
+        with open(path, 'w') as f:
+            f.write("new\n")
+        self.assertIsNone(self.store.known_blob_sha('file.txt'))
+        self.assertEqual(self.repo.git.hash_object('file.txt'), self.store.blob_sha('file.txt'))
+        self.assertIsNone(self.store.known_blob_sha('untracked.txt'))
+
+    def test_commit_without_changes_keeps_other_changes(self):
+        head = self.repo.head.commit
+        with open(os.path.join(self.repo.working_tree_dir, 'untracked.txt'), 'w') as f:
+            f.write("left by a commit which failed to apply\n")
+        with open(os.path.join(self.repo.working_tree_dir, 'file.txt'), 'w') as f:
+            f.write("old\n")
+
+        self.store.commit("Already applied", {'file.txt'})
+
+        self.assertEqual(head, self.repo.head.commit)
+        self.assertEqual(['untracked.txt'], self.repo.untracked_files)
+
+    def test_failed_write_keeps_file(self):
+        with self.assertRaises(RuntimeError):
+            with self.store.open('file.txt', 'wb') as f:
+                f.write(b"partial")
+                raise RuntimeError()
+        self.assertEqual(b"old\n", self.store.read('file.txt'))
+        self.assertEqual(['.git', 'file.txt'], sorted(os.listdir(self.repo.working_tree_dir)))
+
+    def tearDown(self):
+        shutil.rmtree(self.repo.working_tree_dir)
@@ -0,0 +1,157 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+from git import Repo
+from parameterized import parameterized
+
+from utils import ReplacementRewriter, TagIndex, ThreadLocalStream, replacement_rules, stage_paths
+
+
+def sequential_replace(string, rules):
+    for search, replace in rules:
+        string = string.replace(search, replace)
+    return string
+
+
+class TestReplacementRewriter(unittest.TestCase):
+    @parameterized.expand([
+        ('source then target', [
+            ({"from": "src/com/pipeline", "to": "src/com/skybonds"}, 'source'),
+            ({"from": "com.pipeline", "to": "com.skybonds"}, 'source'),
+            ({"from": "src/com/pipeline", "to": "src/com/insly"}, 'target'),
+            ({"from": "com.pipeline", "to": "com.insly"}, 'target'),
+        ], 1),
+        ('chained rules', [
+            ({"from": "a", "to": "b"}, 'target'),
+            ({"from": "b", "to": "c"}, 'target'),
+            ({"from": "c", "to": "d"}, 'target'),
+        ], 1),
+        ('overlapping rules', [
+            ({"from": "cd", "to": "x"}, 'target'),
+            ({"from": "bc", "to": "y"}, 'target'),
+            ({"from": "ab", "to": "z"}, 'target'),
+        ], 1),
+        ('few rules', [
+            ({"from": "a", "to": "b"}, 'target'),
+            ({"from": "b", "to": "c"}, 'target'),
+        ], 2),
+    ])
+    def test_rewrite(self, name, replacements, stages):
+        rules = [rule for replacement, direction in replacements
+                 for rule in replacement_rules([replacement], direction)]
+        rewriter = ReplacementRewriter(rules)
+        buffer = b"import com.skybonds.Config // src/com/skybonds/a.groovy abcd bcd ab\n"
+
+        self.assertEqual(stages, len(rewriter.stages), name)
+        self.assertEqual(sequential_replace(buffer, rules), rewriter(buffer), name)
+
+    def test_matches_sequential_replace(self):
+        rnd = random.Random(7)
+        for _ in range(3000):
+            rules = [(bytes(rnd.choice(b"abc") for _ in range(rnd.randint(1, 3))),
+                      bytes(rnd.choice(b"abcx") for _ in range(rnd.randint(0, 3))))
+                     for _ in range(rnd.randint(1, 5))]
+            buffer = bytes(rnd.choice(b"abcx") for _ in range(rnd.randint(0, 30)))
+
+            self.assertEqual(sequential_replace(buffer, rules), ReplacementRewriter(rules)(buffer), rules)
+
+    def test_stream_matches_whole_buffer(self):
+        rnd = random.Random(11)
+        for _ in range(1000):
+            rules = [(bytes(rnd.choice(b"abc") for _ in range(rnd.randint(1, 3))),
+                      bytes(rnd.choice(b"abcx") for _ in range(rnd.randint(0, 3))))
+                     for _ in range(rnd.randint(1, 5))]
+            buffer = bytes(rnd.choice(b"abcx") for _ in range(rnd.randint(0, 30)))
+            cuts = sorted(rnd.randint(0, len(buffer)) for _ in range(rnd.randint(0, 5)))
+            chunks = [buffer[low:high] for low, high in zip([0] + cuts, cuts + [len(buffer)])]
+
+            self.assertEqual(sequential_replace(buffer, rules), b"".join(ReplacementRewriter(rules).stream(chunks)),
+                             (rules, chunks))
+
+    def test_empty(self):
+        rewriter = ReplacementRewriter([])
+
+        self.assertFalse(rewriter)
+        self.assertEqual(b"content", rewriter(b"content"))
+        self.assertIsNone(rewriter(None))
+
+
+class TestStagePaths(unittest.TestCase):
+    def setUp(self):
+        self.repo = Repo.init(tempfile.mkdtemp())
+        for name, content in [('.gitignore', "*.log\n"), ('kept.txt', "kept\n"), ('removed.txt', "removed\n")]:
+            with open(os.path.join(self.repo.working_tree_dir, name), 'w') as f:
+                f.write(content)
+        self.repo.index.add(['.gitignore', 'kept.txt', 'removed.txt'])
+        self.repo.index.commit("Initial commit")
+
+    def test_stage_paths(self):
+        os.remove(os.path.join(self.repo.working_tree_dir, 'removed.txt'))
+        for name in ['added "file".txt', 'debug.log', 'untouched.txt']:
+            with open(os.path.join(self.repo.working_tree_dir, name), 'w') as f:
+                f.write("new\n")
+
+        stage_paths(self.repo, ['removed.txt', 'added "file".txt', 'debug.log', 'missing.txt'])
+
+        staged = self.repo.git.diff("--cached", "--name-status", "-z").split("\0")
+        self.assertEqual(['A', 'added "file".txt', 'D', 'removed.txt', ''], staged)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo.working_tree_dir)
+
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.repo = Repo.init(tempfile.mkdtemp())
+        self.other_repo = Repo.init(tempfile.mkdtemp())
+        with self.repo.config_writer() as config:
+            config.set_value('user', 'name', "Syncer")
+            config.set_value('user', 'email', "syncer@example.com")
+        first = self.repo.index.commit("Initial commit")
+        second = self.repo.index.commit("Second commit")
+        self.repo.create_tag('v1.10.0', ref=first)
+        self.repo.create_tag('v1.2.0', ref=second, message="Annotated tag")
+        self.repo.create_tag('v2.0.0', ref=second)
+        self.repo.create_tag('v-not-semver', ref=second)
+        self.repo.create_tag('x3.0.0', ref=second)
+        commit = self.other_repo.index.commit("Initial commit")
+        for tag in ['v1.2.0', 'v1.10.0', 'v3.0.0']:
+            self.other_repo.create_tag(tag, ref=commit)
+
+    def test_queries(self):
+        tags = TagIndex(self.repo, 'v')
+
+        self.assertEqual(['v1.2.0', 'v1.10.0', 'v2.0.0'], [tag.name for tag in tags.sorted()])
+        self.assertEqual('v2.0.0', tags.latest().name)
+        self.assertEqual('v1.10.0', tags.common(TagIndex(self.other_repo, 'v')).name)
+        self.assertEqual(self.repo.tags['v1.2.0'].commit.hexsha, tags.commit_sha('v1.2.0'))
+        self.assertIsNone(TagIndex(self.repo, 'y').latest())
+
+    def tearDown(self):
+        shutil.rmtree(self.repo.working_tree_dir)
+        shutil.rmtree(self.other_repo.working_tree_dir)
+
+
+class TestThreadLocalStream(unittest.TestCase):
+    def test_capture_is_per_thread(self):
+        stream = ThreadLocalStream(io.StringIO())
+
+        def write_captured():
+            with stream.capture() as captured:
+                stream.write("worker\n")
+            self.assertEqual("worker\n", captured.getvalue())
+
+        with stream.capture() as captured:
+            stream.write("main\n")
+            worker = threading.Thread(target=write_captured)
+            worker.start()
+            worker.join()
+        stream.write("after\n")
+
+        self.assertEqual("main\n", captured.getvalue())
+        self.assertEqual("after\n", stream.stream.getvalue())
@@ -1,8 +1,13 @@
+import io
 import os
+import re
+import subprocess
+import threading
+from contextlib import contextmanager
 from collections import defaultdict
 
 import semver
-from git import DiffIndex
+from git import DiffIndex, TagReference
 from git.exc import GitCommandError
 
 
@@ -17,28 +22,64 @@ def get_file_changes(patch):
     return file_changes
 
 
-def get_sorted_tags(repo, tag_prefix):
-    tags = [tag for tag in repo.tags if tag.name.startswith(tag_prefix)]
-    return sorted(tags, key=lambda tag: semver.parse_version_info(tag.name[len(tag_prefix):]))
+class TagIndex:
+    """
+    Semver tags of a repository starting with a prefix, read with a single `git for-each-ref`
+
+    Versions are parsed once and the tags are kept sorted, so latest, sorted and common tag queries don't
+    touch the repository again. Tags which are not a valid semver after the prefix are left out.
+    """
+
+    def __init__(self, repo, tag_prefix):
+        self.repo = repo
+        self.tag_prefix = tag_prefix
+        # tag name -> (version, SHA of the tagged commit)
+        self._tags = {}
+        output = self.repo.git.for_each_ref("--format=%(refname:strip=2)%00%(objectname)%00%(*objectname)",
+                                            "refs/tags")
+        for line in output.splitlines():
+            name, sha, peeled_sha = line.split("\0")
+            if not name.startswith(tag_prefix):
+                continue
+            try:
+                version = semver.VersionInfo.parse(name[len(tag_prefix):])
+            except ValueError:
+                continue
+            # annotated tags point to a tag object, the commit is the peeled one
+            self._tags[name] = (version, peeled_sha or sha)
+        self._names = sorted(self._tags, key=self._sort_key)
 
+    def _sort_key(self, name):
+        return self._tags[name][0], name
 
-def find_nearest_common_tag(source_repo, target_repo, tag_prefix):
-    source_tags = get_sorted_tags(source_repo, tag_prefix)
-    target_tags = get_sorted_tags(target_repo, tag_prefix)
+    def _reference(self, name):
+        return TagReference(self.repo, f"refs/tags/{name}")
 
-    common_tags = [tag for tag in source_tags if tag in target_tags]
-    if not common_tags:
-        return None
+    def sorted(self):
+        return [self._reference(name) for name in self._names]
+
+    def latest(self):
+        return self._reference(self._names[-1]) if self._names else None
+
+    def common(self, other):
+        """Highest version tagged in both repositories, as a tag of this one"""
+        names = self._tags.keys() & other._tags.keys()
+        return self._reference(max(names, key=self._sort_key)) if names else None
+
+    def commit_sha(self, name):
+        return self._tags[name][1]
+
+
+def get_sorted_tags(repo, tag_prefix):
+    return TagIndex(repo, tag_prefix).sorted()
 
-    return common_tags[-1]
+
+def find_nearest_common_tag(source_repo, target_repo, tag_prefix):
+    return TagIndex(source_repo, tag_prefix).common(TagIndex(target_repo, tag_prefix))
 
 
 def get_latest_semver_tag(repo, prefix):
-    tags = [tag for tag in repo.tags if tag.name.startswith(prefix)]
-    if not tags:
-        return None
-    tags.sort(key=lambda t: semver.VersionInfo.parse(t.name[len(prefix):]), reverse=True)
-    return tags[0]
+    return TagIndex(repo, prefix).latest()
 
 
 def get_current_files(repo_root, ignore_folders):
@@ -57,6 +98,43 @@ def get_current_files(repo_root, ignore_folders):
     return current_files
 
 
+def exclude_pathspecs(prefixes):
+    """
+    Git pathspecs excluding every path which starts with one of the prefixes, the way `ignore_folders` are
+    matched. Without glob magic a `*` also matches slashes.
+    """
+    return [":(exclude)" + re.sub(r'([*?[\\])', r'\\\1', prefix) + "*" for prefix in prefixes]
+
+
+class PrefixTrie:
+    """Character trie telling whether a path starts with one of the prefixes in a single walk over the path"""
+
+    _END = None
+
+    def __init__(self, prefixes):
+        self._root = {}
+        for prefix in prefixes:
+            node = self._root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[self._END] = True
+
+    def __bool__(self):
+        return bool(self._root)
+
+    def match(self, path):
+        node = self._root
+        if self._END in node:
+            return True
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return False
+
+
 def move_tag(repo, tag_name, new_commit):
     try:
         tag = repo.tags[tag_name]
@@ -67,39 +145,255 @@ def move_tag(repo, tag_name, new_commit):
     repo.create_tag(tag_name, ref=new_commit, force=True)
 
 
-def apply_replacements_to_bytes(string_buffer, replacements, direction):
-    if string_buffer is None:
-        return string_buffer
-
-    string = string_buffer.decode()
+def replacement_rules(replacements, direction):
+    """
+    Turn replacements from the config into (search, replace) byte pairs in the order they are applied
 
+    :param replacements: list of {"from": ..., "to": ...} mappings
+    :param direction: 'source' to replace `to` with `from`, 'target' to replace `from` with `to`
+    """
+    rules = []
     for replacement in replacements:
         # determine a direction of replace for a source we replace to -> from
         #      for target from -> to
         if direction == 'source':
-            replace_from = replacement["to"]
-            replace_to = replacement["from"]
+            rules.append((replacement["to"].encode(), replacement["from"].encode()))
+        else:
+            rules.append((replacement["from"].encode(), replacement["to"].encode()))
+    return rules
+
+
+def _crosses_boundary(search, image, key):
+    """
+    Whether `search` can match across the boundary of `image`, the intermediate replacement of `key`
+
+    Overlaps over a part of the image which is still equal to the key are left out: they mean that the search
+    string overlaps the key itself in the original text, which is detected as a conflict while rewriting.
+    """
+    for length in range(1, min(len(search), len(image))):
+        if search.endswith(image[:length]) and image[:length] != key[:length]:
+            return True
+        if image.endswith(search[:length]) and image[-length:] != key[-length:]:
+            return True
+    return len(search) > len(image) and image in search
+
+
+def _compose_rules(rules):
+    """
+    Compose sequentially applied rules into a single table of search string -> final replacement
+
+    Every search string is mapped to what the whole sequence turns it into. That equals the sequential result
+    as long as no rule matches across the boundary of a replaced string. Search strings which overlap each
+    other only conflict when the text contains them overlapping, so such merged strings are returned as
+    conflicts to look for at rewrite time. Rules that can match across an intermediate replacement make
+    the composition impossible and None is returned.
+
+    :return: (table, conflicts) or None
+    """
+    keys = list(dict.fromkeys(search for search, _ in rules))
+    if not all(keys):
+        return None
+
+    conflicts = set()
+    for first in keys:
+        for second in keys:
+            conflicts.update(first + second[length:] for length in range(1, min(len(first), len(second)))
+                             if first.endswith(second[:length]))
+
+    table = {}
+    for key in keys:
+        image = key
+        for search, replace in rules:
+            if image != key and _crosses_boundary(search, image, key):
+                return None
+            image = image.replace(search, replace)
+        table[key] = image
+    return table, conflicts
+
+
+class _Conflict(Exception):
+    pass
+
+
+class ReplacementRewriter:
+    """
+    Rewrites bytes with a list of replacement rules compiled once
+
+    Rules are applied with the semantics of consecutive `str.replace` calls. When they can be composed, all
+    of them run in a single pass of one alternation regex with a lookup table, falling back to a pass per rule
+    only for buffers where search strings overlap each other. Rules which can't be composed, or so few of them
+    that `bytes.replace` passes are cheaper than a regex pass, get a pass each. Buffers are never decoded.
+    """
+
+    # up to this number of rules consecutive bytes.replace calls are faster than a regex pass
+    sequential_rules_limit = 2
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        composed = _compose_rules(self.rules) if len(self.rules) > self.sequential_rules_limit else None
+        if composed is None:
+            self.stages = [self._compile_stage({search: replace}) for search, replace in self.rules]
         else:
-            replace_from = replacement["from"]
-            replace_to = replacement["to"]
+            table, conflicts = composed
+            self.stages = [self._compile_stage(table, conflicts)] if table else []
+
+    @staticmethod
+    def _compile_stage(table, conflicts=()):
+        alternatives = sorted(set(table) | set(conflicts), key=len, reverse=True)
+        pattern = re.compile(b"|".join(re.escape(alternative) for alternative in alternatives))
+        return pattern, table, frozenset(conflicts)
+
+    def __bool__(self):
+        return bool(self.stages)
+
+    def __call__(self, buffer):
+        if buffer is None:
+            return buffer
+
+        for pattern, table, conflicts in self.stages:
+            if not conflicts and len(table) == 1:
+                ((search, replace),) = table.items()
+                buffer = buffer.replace(search, replace)
+            elif not conflicts:
+                buffer = pattern.sub(lambda match: table[match.group()], buffer)
+            else:
+                try:
+                    buffer = pattern.sub(lambda match: self._lookup(table, conflicts, match.group()), buffer)
+                except _Conflict:
+                    for search, replace in self.rules:
+                        buffer = buffer.replace(search, replace)
+        return buffer
+
+    def stream(self, chunks):
+        """
+        Rewrite a stream of chunks, giving the same result as rewriting their concatenation
+
+        Every stage keeps the tail of a chunk which a match could still continue into and prepends it to the
+        next chunk, so nothing more than a chunk and the longest search string is held in memory. Composed
+        stages with conflicts need the whole buffer for the fallback, so their rules are streamed one by one.
+
+        :param chunks: iterable of bytes
+        :return: iterator of rewritten bytes
+        """
+        stages = self.stages
+        if any(conflicts for _, _, conflicts in stages):
+            stages = [self._compile_stage({search: replace}) for search, replace in self.rules]
+        if any(not search for _, table, _ in stages for search in table):
+            # an empty search string matches everywhere, there is no tail to keep
+            return iter([self(b"".join(chunks))])
+
+        for pattern, table, _ in stages:
+            chunks = self._stream_stage(pattern, table, chunks)
+        return chunks
+
+    @staticmethod
+    def _stream_stage(pattern, table, chunks):
+        # a match starting before the last `overlap` bytes is complete, later data can't change it
+        overlap = max(map(len, table)) - 1
+        carry = b""
+        for chunk in chunks:
+            buffer = carry + chunk
+            safe = len(buffer) - overlap
+            output = []
+            position = 0
+            for match in pattern.finditer(buffer):
+                if match.start() >= safe:
+                    break
+                output.append(buffer[position:match.start()])
+                output.append(table[match.group()])
+                position = match.end()
+            if position < safe:
+                output.append(buffer[position:safe])
+                position = safe
+            carry = buffer[position:]
+            yield b"".join(output)
+        yield pattern.sub(lambda match: table[match.group()], carry)
+
+    @staticmethod
+    def _lookup(table, conflicts, found):
+        if found in conflicts:
+            raise _Conflict()
+        return table[found]
 
-        string = string.replace(replace_from, replace_to)
 
-    return string.encode()
+def apply_replacements_to_bytes(string_buffer, replacements, direction):
+    return ReplacementRewriter(replacement_rules(replacements, direction))(string_buffer)
 
 
-def apply_replacements_to_patch(diff_index: DiffIndex, replacements, direction='source'):
-    if len(replacements) == 0:
+def apply_replacements_to_patch(diff_index: DiffIndex, rewriter: ReplacementRewriter):
+    if not rewriter:
         return diff_index
 
     for diff in diff_index:
-        diff.a_rawpath = apply_replacements_to_bytes(diff.a_rawpath, replacements, direction)
-        diff.b_rawpath = apply_replacements_to_bytes(diff.b_rawpath, replacements, direction)
-        diff.diff = apply_replacements_to_bytes(diff.diff, replacements, direction)
+        diff.a_rawpath = rewriter(diff.a_rawpath)
+        diff.b_rawpath = rewriter(diff.b_rawpath)
+        diff.diff = rewriter(diff.diff)
 
     return diff_index
 
 
+def _git_with_paths(repo, command, paths, *args, allowed_statuses=(0,)):
+    """Run a git command reading NUL separated paths from stdin, so no path is quoted or limited by argv"""
+    process = getattr(repo.git, command)(*args, "-z", "--stdin", as_process=True, istream=subprocess.PIPE)
+    stdout, stderr = process.communicate(b"".join(path.encode() + b"\0" for path in paths))
+    if process.returncode not in allowed_statuses:
+        raise GitCommandError(["git", command.replace("_", "-"), *args], process.returncode, stderr, stdout)
+    return [path.decode() for path in stdout.split(b"\0") if path]
+
+
+def stage_paths(repo, paths):
+    """
+    Stage the current state of the given paths only, instead of `git add .` over the whole working tree
+
+    Like `git add`, untracked paths matched by .gitignore are skipped. Paths missing from the working tree
+    are removed from the index.
+
+    :param repo: repository to update the index of
+    :param paths: paths relative to the repository root
+    """
+    paths = sorted(paths)
+    if not paths:
+        return
+
+    # tracked paths are never reported as ignored, check-ignore exits with 1 when nothing is
+    ignored = set(_git_with_paths(repo, "check_ignore", paths, allowed_statuses=(0, 1)))
+    paths = [path for path in paths if path not in ignored]
+    if paths:
+        _git_with_paths(repo, "update_index", paths, "--add", "--remove", "--replace")
+
+
+class ThreadLocalStream:
+    """
+    Stream passing writes to the wrapped one, unless the writing thread captures its output
+
+    Installed as sys.stdout and sys.stderr it lets concurrent work collect its own prints and logs, so they
+    can be written out in a stable order.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        if getattr(self._local, 'buffer', None) is None:
+            self.stream.flush()
+
+    @contextmanager
+    def capture(self):
+        self._local.buffer = io.StringIO()
+        try:
+            yield self._local.buffer
+        finally:
+            self._local.buffer = None
+
+
 def commit_changes(repo, message):
     try:
         repo.git.commit("-m", message)
@@ -114,9 +408,9 @@ def commit_changes(repo, message):
     return True
 
 
-def create_tag(logger, repo, tag, message):
+def create_tag(logger, repo, tag, message, ref='HEAD'):
     try:
-        new_tag = repo.create_tag(tag, message=message)
+        new_tag = repo.create_tag(tag, ref=ref, message=message)
         logger.info(f"Tag {tag} created successfully.")
         return new_tag
     except Exception as e: